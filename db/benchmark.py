@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+import vdf
+import tf2idb
+import reader
+import sqlite3
+import multiprocessing
+import resource
+import tempfile
+import random
+import json
+import time
+import sys
+import os
+
+CLASSES = [ 'scout', 'soldier', 'pyro', 'Demoman', 'heavy', 'engineer', 'medic', 'sniper', 'spy' ]
+
+QUALITIES = [ 'normal', 'rarity1', 'genuine', 'rarity2', 'vintage', 'rarity3', 'unusual',
+        'unique', 'community', 'developer', 'selfmade', 'customized', 'strange' ]
+
+RARITIES = [ 'common', 'uncommon', 'rare', 'mythical', 'legendary', 'ancient' ]
+
+def generate_items_game(path: str, items = 30000, prefab_depth = 3, attributes = 4,
+        regions = 40, seed = 0):
+    '''
+    Writes a synthetic items_game.txt with the sections tf2idb.parse() reads.
+
+    :param path:  The file to write to.
+    :param items:  Number of item definitions.
+    :param prefab_depth:  Length of the prefab chains items inherit from.
+    :param attributes:  Number of attributes per item.
+    :param regions:  Number of equip regions.
+    :param seed:  Seed for the random choices, so fixtures with the same parameters are equal.
+    '''
+    rng = random.Random(seed)
+    num_attributes = max(attributes * 20, 100)
+    num_prefabs = max(items // 100, prefab_depth)
+
+    def attribute_name(n):
+        return 'attribute {}'.format(n)
+
+    with open(path, 'w') as f:
+        def write(level, text):
+            f.write('\t' * level + text + '\n')
+
+        def write_block(level, key, values):
+            write(level, '"{}"'.format(key))
+            write(level, '{')
+            for k, v in values.items():
+                if isinstance(v, dict):
+                    write_block(level + 1, k, v)
+                else:
+                    write(level + 1, '"{}"\t"{}"'.format(k, v))
+            write(level, '}')
+
+        write(0, '"items_game"')
+        write(0, '{')
+
+        write_block(1, 'qualities', { q: { 'value': n } for n, q in enumerate(QUALITIES) })
+        write_block(1, 'rarities', { r: { 'value': n + 1 } for n, r in enumerate(RARITIES) })
+
+        write_block(1, 'equip_conflicts', { 'region {}'.format(n): {
+                'region {}'.format((n + 1) % regions): 1 } for n in range(0, regions, 4) })
+
+        write_block(1, 'item_collections', { 'collection {}'.format(n): {
+                'items': { rarity: { 'Item {}'.format(defindex): 1
+                for defindex in range(n * 7 + r, items, 997) }
+                for r, rarity in enumerate(RARITIES) } } for n in range(4) })
+
+        # chains of prefab_depth prefabs, each inheriting from the previous one
+        prefabs = {}
+        for n in range(num_prefabs):
+            prefab = {
+                'item_class': 'tf_wearable',
+                'item_slot': rng.choice([ 'head', 'misc', 'primary', 'secondary', 'melee' ]),
+                'item_quality': 'unique',
+                'equip_region': 'region {}'.format(rng.randrange(regions)),
+                'used_by_classes': { c: 1 for c in rng.sample(CLASSES, rng.randint(1, 9)) },
+                'capabilities': { 'nameable': 1, 'paintable': rng.randint(0, 1) },
+                'static_attrs': { attribute_name(num_attributes - 1 - n % 10): n },
+            }
+            if n % prefab_depth:
+                prefab['prefab'] = 'prefab_{}'.format(n - 1)
+            prefabs['prefab_{}'.format(n)] = prefab
+        write_block(1, 'prefabs', prefabs)
+
+        write(1, '"items"')
+        write(1, '{')
+        for defindex in range(items):
+            item = {
+                'name': 'Item {}'.format(defindex),
+                'item_name': '#TF_Item_{}'.format(defindex),
+                'model_player': 'models/items/item_{}.mdl'.format(defindex),
+            }
+            if defindex % 10:
+                item['prefab'] = 'prefab_{}'.format(rng.randrange(num_prefabs))
+            else:
+                item['item_class'] = 'tf_weapon'
+                item['item_quality'] = 'normal'
+                item['used_by_classes'] = { c: 1 for c in CLASSES }
+            if defindex % 3 == 0:
+                item['equip_regions'] = { 'region {}'.format(r): 1
+                        for r in rng.sample(range(regions), 2) }
+            item['attributes'] = { attribute_name(a): {
+                    'attribute_class': 'class_{}'.format(a), 'value': rng.choice(['1', '0.5', '2']) }
+                    for a in rng.sample(range(num_attributes - 10), attributes) }
+            write_block(2, defindex, item)
+        write(1, '}')
+
+        write_block(1, 'attributes', { n: {
+                'name': attribute_name(n),
+                'attribute_class': 'class_{}'.format(n),
+                'description_string': '#Attrib_{}'.format(n),
+                'description_format': 'value_is_percentage',
+                'hidden': n % 2,
+                'effect_type': 'positive',
+                'stored_as_integer': int(n % 3 == 0),
+        } for n in range(num_attributes) })
+
+        write_block(1, 'attribute_controlled_attached_particles', {
+                'cosmetic_unusual_effects': { n: { 'system': 'particle_{}'.format(n) }
+                for n in range(1, 100) } })
+
+        write(0, '}')
+
+def run_phase(phase, items_game: str, database: str):
+    '''
+    Sets up a phase and times it, returning the timings.  Called in a fresh process, so the peak
+    RSS belongs to this phase alone (including its setup).
+    '''
+    run = phase(items_game, database)
+    wall, cpu = time.perf_counter(), time.process_time()
+    items = run()
+    details = {}
+    if isinstance(items, tuple):
+        items, details = items
+    return dict({
+        'items': items,
+        'seconds': time.perf_counter() - wall,
+        'cpu_seconds': time.process_time() - cpu,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }, **details)
+
+# each phase does its setup and returns a function that runs the timed part and returns the
+# number of items it handled, or (items, details) with more results for the phase
+
+# phases of tf2idb.parse() reported within the build phase, as 'parse_phases'
+PARSE_PHASES = [ 'items', 'indexes', 'finalize' ]
+
+def phase_vdf_parse(items_game: str, database: str):
+    def run():
+        with open(items_game) as f:
+            return len(vdf.parse(f)['items_game']['items'])
+    return run
+
+def phase_resolve_prefabs(items_game: str, database: str):
+    prefabs = tf2idb.load_sections(items_game, [ 'prefabs' ])['prefabs']
+    items = [ v for id, v in tf2idb.iter_items(items_game) if id != 'default' ]
+    def run():
+        resolver = tf2idb.PrefabResolver(prefabs)
+        for v in items:
+            resolver.resolve(v)
+        return len(items)
+    return run
+
+def phase_build(items_game: str, database: str):
+    def run():
+        stats = {}
+        with sqlite3.connect(database) as db:
+            tf2idb.parse(items_game, db, vacuum = False,
+                    observer = lambda phase, phase_stats: stats.setdefault(phase, phase_stats))
+            items = db.execute('SELECT COUNT(*) FROM tf2idb_item').fetchone()[0]
+        return items, { 'parse_phases': { phase: stats[phase] for phase in PARSE_PHASES } }
+    return run
+
+def phase_vacuum(items_game: str, database: str):
+    def run():
+        with sqlite3.connect(database) as db:
+            db.execute('VACUUM')
+            return db.execute('SELECT COUNT(*) FROM tf2idb_item').fetchone()[0]
+    return run
+
+PHASES = [
+    ('vdf_parse', phase_vdf_parse),
+    ('resolve_prefabs', phase_resolve_prefabs),
+    ('build', phase_build),
+    ('vacuum', phase_vacuum),
+]
+
+def benchmark(items_game: str, database: str, repeat = 1):
+    '''
+    Times each of PHASES on items_game.txt and returns the results as a dict keyed by phase.
+    The best of ``repeat`` runs is reported.
+    '''
+    results = {}
+    for name, phase in PHASES:
+        runs = []
+        for _ in range(repeat):
+            if phase is phase_build and os.path.exists(database):
+                os.remove(database)
+            with multiprocessing.Pool(1) as pool:
+                runs.append(pool.apply(run_phase, (phase, items_game, database)))
+
+        result = min(runs, key = lambda run: run['seconds'])
+        result['items_per_second'] = result['items'] / result['seconds']
+        results[name] = result
+    return results
+
+# the statements tf2idb.sp prepares for the lookups timed by benchmark_reader()
+READER_STATEMENTS = {
+    'get_item_slot_name': "SELECT slot FROM tf2idb_class WHERE id=? AND (class=? OR class='all')",
+    'get_item_attributes': "SELECT attribute,value FROM tf2idb_item_attributes WHERE id=?",
+    'do_regions_conflict': "SELECT a.name FROM tf2idb_equip_conflicts a JOIN tf2idb_equip_conflicts b ON a.name=b.name WHERE a.region=? AND b.region=?",
+}
+
+def benchmark_reader(database: str, lookups = 100000, seed = 0):
+    '''
+    Times lookups through the statements of tf2idb.sp against reader.Reader with and without
+    preload, returning the microseconds per lookup keyed by method and mode.  The lookups pick
+    random items, classes and regions of the database.
+    '''
+    rng = random.Random(seed)
+    with sqlite3.connect(database) as db:
+        ids = [ id for id, in db.execute('SELECT id FROM tf2idb_item') ]
+        regions = [ region for region, in db.execute(
+                'SELECT DISTINCT region FROM tf2idb_equip_conflicts') ]
+    args = {
+        'get_item_slot_name': [ (rng.choice(ids), rng.choice(reader.CLASS_MAPPINGS[1:]))
+                for _ in range(lookups) ],
+        'get_item_attributes': [ (rng.choice(ids),) for _ in range(lookups) ],
+        'do_regions_conflict': [ (rng.choice(regions), rng.choice(regions))
+                for _ in range(lookups) ],
+    }
+
+    def time_lookups(lookup, method):
+        start = time.perf_counter()
+        for a in args[method]:
+            lookup(*a)
+        return (time.perf_counter() - start) * 1e6 / lookups
+
+    results = {}
+    for method, statement in READER_STATEMENTS.items():
+        with sqlite3.connect(database) as db:
+            results[method] = { 'sql': time_lookups(
+                    lambda *a: db.execute(statement, a).fetchall(), method) }
+        for mode, preload in [ ('lru', False), ('preload', True) ]:
+            with reader.Reader(database, preload = preload) as r:
+                results[method][mode] = time_lookups(getattr(r, method), method)
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Times the stages of building a TF2IDB database.",
+            usage='%(prog)s [options]')
+
+    parser.add_argument('--items-game', metavar='ITEMS',
+            help="benchmark an existing items_game.txt instead of a synthetic one")
+    parser.add_argument('--items', type=int, default=30000, help="number of synthetic items")
+    parser.add_argument('--prefab-depth', type=int, default=3, help="length of prefab chains")
+    parser.add_argument('--attributes', type=int, default=4, help="attributes per item")
+    parser.add_argument('--regions', type=int, default=40, help="number of equip regions")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per phase, best is kept")
+    parser.add_argument('--lookups', type=int, default=100000,
+            help="lookups per reader benchmark, 0 to skip it")
+    parser.add_argument('--output', metavar='FILE', help="write the JSON results to FILE")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        items_game = args.items_game
+        fixture = { 'items_game': items_game }
+        if not items_game:
+            items_game = os.path.join(workdir, 'items_game.txt')
+            fixture = { 'items': args.items, 'prefab_depth': args.prefab_depth,
+                    'attributes': args.attributes, 'regions': args.regions }
+            generate_items_game(items_game, args.items, args.prefab_depth, args.attributes,
+                    args.regions)
+        fixture['size'] = os.path.getsize(items_game)
+
+        database = os.path.join(workdir, 'tf2idb.sq3')
+        phases = benchmark(items_game, database, args.repeat)
+        lookups = benchmark_reader(database, args.lookups) if args.lookups else {}
+
+    report = json.dumps({
+        'fixture': fixture,
+        'python': sys.version.split()[0],
+        'phases': phases,
+        'lookups_us': lookups,
+    }, indent = 4)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+    for name, result in phases.items():
+        print('{:<16} {:8.2f}s {:10.0f} items/s {:8d} KB peak'.format(name, result['seconds'],
+                result['items_per_second'], result['peak_rss_kb']), file = sys.stderr)
+        for phase, stats in result.get('parse_phases', {}).items():
+            print('  {:<14} {:8.2f}s'.format(phase, stats['seconds']), file = sys.stderr)
+
+    for method, result in lookups.items():
+        print('{:<20} {}'.format(method, '  '.join('{} {:.2f}us'.format(mode, us)
+                for mode, us in result.items())), file = sys.stderr)
+
+    if not args.output:
+        print(report)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+import sqlite3
+import collections
+import functools
+import json
+import re
+from snapshot import Snapshot, Item, Attribute
+
+# TFClassType order used by the natives, index 0 is TFClass_Unknown
+CLASS_MAPPINGS = [ 'unknown', 'scout', 'sniper', 'soldier', 'demoman', 'medic', 'heavy', 'pyro',
+        'spy', 'engineer' ]
+
+# slot names to TF2ItemSlot values, see g_slot_mappings in tf2idb.sp
+SLOT_MAPPINGS = { 'primary': 0, 'secondary': 1, 'melee': 2, 'pda': 3, 'pda2': 4, 'building': 5,
+        'head': 5, 'misc': 6, 'action': 7, 'taunt': 8 }
+
+# attribute columns returned by get_attribute_properties(), in the order of the native
+ATTRIBUTE_PROPERTIES = Attribute._fields[-5:]
+
+# default number of items (and attributes) kept by each lookup cache when not preloading
+CACHE_SIZE = 4096
+
+# default number of results of search_items()
+SEARCH_LIMIT = 10
+
+# bm25() weights of the name, item_name and localized columns of tf2idb_item_search; players
+# search by the names shown in game, so matches on those rank first
+SEARCH_WEIGHTS = (1.0, 2.0, 4.0)
+
+ITEM_QUERY = 'SELECT id, name, item_name, class, slot, quality, min_ilevel, max_ilevel, model_player FROM tf2idb_item'
+ATTRIBUTE_QUERY = 'SELECT id, {} FROM tf2idb_attributes'.format(', '.join(Attribute._fields))
+
+def attribute_value(value: str, number):
+    '''
+    Returns an attribute value as a float like TF2IDB_GetItemAttributes() does, from the
+    numeric_value column of tf2idb_item_attributes.  Values of attributes that are not numbers
+    (string attributes) are kept as they are.
+    '''
+    return value if number is None else float(number)
+
+def search_expression(query: str):
+    '''
+    Returns an FTS5 query matching the items with a word starting with each word of ``query``,
+    or None if it has no words.
+    '''
+    words = re.findall(r'[^\W_]+', query)
+    return ' '.join('"{}"*'.format(word) for word in words) if words else None
+
+def class_name(class_type):
+    '''
+    Returns the tf2idb_class name for a TFClassType value or a class name.
+    '''
+    if isinstance(class_type, int):
+        return CLASS_MAPPINGS[class_type]
+    return class_type.lower()
+
+class Reader:
+    '''
+    Read access to a database built by tf2idb.py, with methods mirroring the natives of
+    tf2idb.inc.  Lookups return None (or an empty list) where a native returns false.
+
+    With preload, the item and attribute tables are read into dicts keyed by defindex when
+    opened and lookups never touch the database.  Otherwise every table is queried per item and
+    the results are kept in LRU caches of cache_size entries.  The small tables (qualities,
+    particles and equip region masks) are always loaded.
+
+    With a snapshot, items, attributes and item attributes are read from it instead of the
+    database, the other tables are still preloaded or cached.
+    '''
+    def __init__(self, database, preload = True, cache_size = CACHE_SIZE, snapshot = None):
+        '''
+        :param database:  Path to the database or an SQLite3 connection.
+        :param preload:  Whether or not to read all items and attributes when opened.
+        :param cache_size:  The number of entries kept by each lookup cache without preload.
+        :param snapshot:  Path to a snapshot written with the database, or a Snapshot.
+        '''
+        self.db = sqlite3.connect(database) if isinstance(database, str) else database
+
+        self.qualities = dict(self.db.execute('SELECT name, value FROM tf2idb_qualities'))
+        self.quality_names = { value: name for name, value in self.qualities.items() }
+        self.particles = [ id for id, in self.db.execute('SELECT id FROM tf2idb_particles') ]
+
+        # bit n of a region's mask is set if it conflicts with the region with id n
+        self.region_ids = {}
+        self.region_masks = {}
+        for region, id, mask in self.db.execute(
+                'SELECT region, id, mask FROM tf2idb_equip_region_masks'):
+            self.region_ids[region] = id
+            self.region_masks[region] = int.from_bytes(mask, 'little')
+
+        self.snapshot = Snapshot(snapshot) if isinstance(snapshot, str) else snapshot
+
+        if preload:
+            self._load()
+        else:
+            cache = functools.lru_cache(maxsize = cache_size)
+            self.item = cache(self._query_item)
+            self.item_classes = cache(self._query_item_classes)
+            self.item_attributes = cache(self._query_item_attributes)
+            self.item_equip_regions = cache(self._query_item_equip_regions)
+            self.attribute = cache(self._query_attribute)
+
+        if self.snapshot is not None:
+            self.item = self.snapshot.item
+            self.item_attributes = self.snapshot.item_attributes
+            self.attribute = self.snapshot.attribute
+
+    def _load(self):
+        classes = collections.defaultdict(dict)
+        for id, name, slot in self.db.execute('SELECT id, class, slot FROM tf2idb_class'):
+            classes[id][name] = slot
+
+        regions = collections.defaultdict(list)
+        for id, region in self.db.execute(
+                'SELECT id, region FROM tf2idb_equip_regions ORDER BY id, region'):
+            regions[id].append(region)
+
+        self.item_classes = lambda id: classes.get(id, {})
+        self.item_equip_regions = lambda id: regions.get(id, [])
+
+        if self.snapshot is not None:
+            return
+
+        items = { id: Item(*row) for id, *row in self.db.execute(ITEM_QUERY) }
+        attributes = { id: Attribute(*row) for id, *row in self.db.execute(ATTRIBUTE_QUERY) }
+
+        item_attributes = collections.defaultdict(list)
+        for id, attribute, value, number in self.db.execute('SELECT id, attribute, value, '
+                'numeric_value FROM tf2idb_item_attributes ORDER BY id, attribute'):
+            item_attributes[id].append((attribute, attribute_value(value, number)))
+
+        self.item = items.get
+        self.attribute = attributes.get
+        self.item_attributes = lambda id: item_attributes.get(id, [])
+
+    def _query_item(self, id: int):
+        row = self.db.execute(ITEM_QUERY + ' WHERE id=?', (id,)).fetchone()
+        return Item(*row[1:]) if row else None
+
+    def _query_item_classes(self, id: int):
+        return dict(self.db.execute('SELECT class, slot FROM tf2idb_class WHERE id=?', (id,)))
+
+    def _query_item_attributes(self, id: int):
+        return [ (attribute, attribute_value(value, number)) for attribute, value, number in
+                self.db.execute('SELECT attribute, value, numeric_value FROM tf2idb_item_attributes '
+                'WHERE id=? ORDER BY attribute', (id,)) ]
+
+    def _query_item_equip_regions(self, id: int):
+        return [ region for region, in self.db.execute(
+                'SELECT region FROM tf2idb_equip_regions WHERE id=? ORDER BY region', (id,)) ]
+
+    def _query_attribute(self, id: int):
+        row = self.db.execute(ATTRIBUTE_QUERY + ' WHERE id=?', (id,)).fetchone()
+        return Attribute(*row[1:]) if row else None
+
+    def close(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # items
+
+    def is_valid_item_id(self, id: int):
+        return self.item(id) is not None
+
+    def get_item_name(self, id: int):
+        item = self.item(id)
+        return item.name if item else None
+
+    def get_item_class(self, id: int):
+        item = self.item(id)
+        return item.class_name if item else None
+
+    def get_item_slot_name(self, id: int, class_type = None):
+        '''
+        Returns the slot of an item, or the slot it takes for a class (a TFClassType value or a
+        class name) if given.
+        '''
+        if class_type is None or class_type == 0:
+            item = self.item(id)
+            return item.slot if item else None
+
+        classes = self.item_classes(id)
+        slot = classes.get(class_name(class_type))
+        return slot if slot is not None else classes.get('all')
+
+    def get_item_slot(self, id: int, class_type = None):
+        '''
+        Returns the TF2ItemSlot value of an item's slot, -1 if it has none.
+        '''
+        return SLOT_MAPPINGS.get(self.get_item_slot_name(id, class_type), -1)
+
+    def get_item_quality_name(self, id: int):
+        item = self.item(id)
+        return item.quality if item else None
+
+    def get_item_quality(self, id: int):
+        '''
+        Returns the TF2ItemQuality value of an item's quality, TF2ItemQuality_Normal (0) if it is
+        unknown.
+        '''
+        return max(self.get_quality_by_name(self.get_item_quality_name(id)), 0)
+
+    def get_item_levels(self, id: int):
+        '''
+        Returns (min_ilevel, max_ilevel) for an item.
+        '''
+        item = self.item(id)
+        return (item.min_ilevel, item.max_ilevel) if item else None
+
+    def get_item_attributes(self, id: int):
+        '''
+        Returns a list of (attribute id, value) for the attributes of an item.
+        '''
+        return self.item_attributes(id)
+
+    def get_item_model(self, id: int):
+        item = self.item(id)
+        return item.model_player if item else None
+
+    def get_item_equip_regions(self, id: int):
+        return self.item_equip_regions(id)
+
+    def get_item_loadout(self, id: int):
+        '''
+        Returns everything about an item as a dict, from a database built with loadout.  Always
+        reads the database.
+        '''
+        row = self.db.execute('SELECT loadout FROM tf2idb_item_loadout WHERE id=?',
+                (id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def search_items(self, query: str, limit = SEARCH_LIMIT):
+        '''
+        Returns a list of (defindex, name) for the items with a word starting with each word of
+        ``query`` in their name, item_name or localized name, best matches first, from a
+        database built with search.  Always reads the database.
+        '''
+        expression = search_expression(query)
+        if expression is None:
+            return []
+        return self.db.execute('SELECT rowid, name FROM tf2idb_item_search '
+                'WHERE tf2idb_item_search MATCH ? ORDER BY bm25(tf2idb_item_search, {}), rowid '
+                'LIMIT ?'.format(', '.join(map(str, SEARCH_WEIGHTS))), (expression, limit)).fetchall()
+
+    def do_regions_conflict(self, region1: str, region2: str):
+        id = self.region_ids.get(region2)
+        return id is not None and bool(self.region_masks.get(region1, 0) >> id & 1)
+
+    def get_item_region_mask(self, id: int):
+        '''
+        Returns the bitmask of the region ids of an item's equip regions.
+        '''
+        mask = 0
+        for region in self.item_equip_regions(id):
+            mask |= 1 << self.region_ids[region]
+        return mask
+
+    def get_item_conflict_mask(self, id: int):
+        '''
+        Returns the bitmask of the region ids an item can not be worn with: its own equip
+        regions and every region they conflict with.
+        '''
+        mask = 0
+        for region in self.item_equip_regions(id):
+            mask |= 1 << self.region_ids[region] | self.region_masks[region]
+        return mask
+
+    def do_items_conflict(self, id1: int, id2: int):
+        '''
+        Returns whether two items share an equip region or have conflicting equip regions.
+        '''
+        return bool(self.get_item_region_mask(id1) & self.get_item_conflict_mask(id2))
+
+    def list_particles(self):
+        '''
+        Returns the ids of the particle effects, without the ones TF2IDB_ListParticles() leaves
+        out.
+        '''
+        return [ effect for effect in self.particles
+                if 5 < effect < 2000 and effect != 20 and effect != 28 ]
+
+    def item_has_attribute(self, id: int, attribute_id: int):
+        return any(attribute == attribute_id for attribute, _ in self.item_attributes(id))
+
+    def used_by_classes(self, id: int):
+        '''
+        Returns a bitmask of the TFClassType values using an item.  Like TF2IDB_UsedByClasses(),
+        'all' sets bit 0 (TFClass_Unknown).
+        '''
+        result = 0
+        for name in self.item_classes(id):
+            result |= 1 << (CLASS_MAPPINGS.index(name) if name in CLASS_MAPPINGS else 0)
+        return result
+
+    # attributes
+
+    def is_valid_attribute_id(self, id: int):
+        return self.attribute(id) is not None
+
+    def _attribute_field(self, id: int, field: str):
+        attribute = self.attribute(id)
+        return getattr(attribute, field) if attribute else None
+
+    def get_attribute_name(self, id: int):
+        return self._attribute_field(id, 'name')
+
+    def get_attribute_class(self, id: int):
+        return self._attribute_field(id, 'attribute_class')
+
+    def get_attribute_type(self, id: int):
+        return self._attribute_field(id, 'attribute_type')
+
+    def get_attribute_desc_string(self, id: int):
+        return self._attribute_field(id, 'description_string')
+
+    def get_attribute_desc_format(self, id: int):
+        return self._attribute_field(id, 'description_format')
+
+    def get_attribute_effect_type(self, id: int):
+        return self._attribute_field(id, 'effect_type')
+
+    def get_attribute_armory_desc(self, id: int):
+        return self._attribute_field(id, 'armory_desc')
+
+    def get_attribute_item_tag(self, id: int):
+        return self._attribute_field(id, 'apply_tag_to_item_definition')
+
+    def get_attribute_properties(self, id: int):
+        '''
+        Returns the ATTRIBUTE_PROPERTIES of an attribute as a tuple of ints, -1 where not set.
+        '''
+        attribute = self.attribute(id)
+        if not attribute:
+            return None
+        return tuple(-1 if getattr(attribute, field) is None else int(getattr(attribute, field))
+                for field in ATTRIBUTE_PROPERTIES)
+
+    # qualities
+
+    def get_quality_name(self, quality: int):
+        return self.quality_names.get(quality)
+
+    def get_quality_by_name(self, name: str):
+        '''
+        Returns the TF2ItemQuality value of a quality name, -1 if it is unknown.
+        '''
+        return self.qualities.get(name, -1)
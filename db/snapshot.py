@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import sqlite3
+import struct
+import mmap
+import bisect
+import os
+import collections
+
+# a snapshot is a little-endian file made of a header followed by these sections, each
+# starting at the offset stored for it in the header:
+#
+#   item ids             int32 per item, sorted
+#   items                ITEM_RECORD per item, in the order of the ids
+#   attribute ids        int32 per attribute, sorted
+#   attributes           ATTRIBUTE_RECORD per attribute, in the order of the ids
+#   item attributes      ITEM_ATTRIBUTE_RECORD per row of tf2idb_item_attributes, grouped by item
+#   string offsets       uint32 per string plus one, into the string data
+#   string data          UTF-8 strings, each stored once
+#
+# strings are referenced by their index, NO_STRING standing for NULL; integers that can be NULL
+# use NO_INT instead
+SNAPSHOT_MAGIC = b'TF2IDBSN'
+
+# bump whenever the layout changes, older snapshots are refused by Snapshot
+SNAPSHOT_VERSION = 2
+
+SNAPSHOT_EXTENSION = '.snap'
+
+HEADER = struct.Struct('<8sI7I')
+
+# name, item_name, class, slot, quality, min_ilevel, max_ilevel, model_player,
+# first item attribute, number of item attributes
+ITEM_RECORD = struct.Struct('<5I2i3I')
+
+# name, attribute_class, attribute_type, description_string, description_format, effect_type,
+# armory_desc, apply_tag_to_item_definition, hidden, stored_as_integer, is_set_bonus,
+# is_user_generated, can_affect_recipe_component_name
+ATTRIBUTE_RECORD = struct.Struct('<8I5i')
+
+# attribute, value as a string (NO_STRING if it is a number), value as a number (numeric_value)
+ITEM_ATTRIBUTE_RECORD = struct.Struct('<IId')
+
+NO_STRING = 0xFFFFFFFF
+NO_INT = -0x80000000
+
+Item = collections.namedtuple('Item', [ 'name', 'item_name', 'class_name', 'slot', 'quality',
+        'min_ilevel', 'max_ilevel', 'model_player' ])
+
+Attribute = collections.namedtuple('Attribute', [ 'name', 'attribute_class', 'attribute_type',
+        'description_string', 'description_format', 'effect_type', 'armory_desc',
+        'apply_tag_to_item_definition', 'hidden', 'stored_as_integer', 'is_set_bonus',
+        'is_user_generated', 'can_affect_recipe_component_name' ])
+
+def snapshot_path(database_file: str):
+    '''
+    Returns the path of the snapshot kept next to a database file.
+    '''
+    return os.path.splitext(database_file)[0] + SNAPSHOT_EXTENSION
+
+def write_snapshot(db: sqlite3.Connection, path: str):
+    '''
+    Writes a snapshot of the items and attributes of a database built by tf2idb.py.  The file
+    is replaced atomically, so readers never see a partial snapshot.
+    '''
+    strings = {}
+
+    def string(value):
+        if value is None:
+            return NO_STRING
+        return strings.setdefault(str(value), len(strings))
+
+    def integer(value):
+        return NO_INT if value is None else int(value)
+
+    item_attributes = bytearray()
+    item_ranges = {}
+    count = 0
+    for id, attribute, value, number in db.execute('SELECT id, attribute, value, numeric_value '
+            'FROM tf2idb_item_attributes ORDER BY id, attribute'):
+        if number is not None:
+            record = ITEM_ATTRIBUTE_RECORD.pack(attribute, NO_STRING, number)
+        else:
+            record = ITEM_ATTRIBUTE_RECORD.pack(attribute, string(value), 0)
+        item_attributes += record
+        start, _ = item_ranges.get(id, (count, 0))
+        item_ranges[id] = (start, count + 1 - start)
+        count += 1
+
+    item_ids = []
+    items = bytearray()
+    for id, name, item_name, cls, slot, quality, min_ilevel, max_ilevel, model in db.execute(
+            'SELECT id, name, item_name, class, slot, quality, min_ilevel, max_ilevel, '
+            'model_player FROM tf2idb_item ORDER BY id'):
+        item_ids.append(id)
+        items += ITEM_RECORD.pack(string(name), string(item_name), string(cls), string(slot),
+                string(quality), integer(min_ilevel), integer(max_ilevel), string(model),
+                *item_ranges.get(id, (0, 0)))
+
+    attribute_ids = []
+    attributes = bytearray()
+    for id, *row in db.execute('SELECT id, {} FROM tf2idb_attributes ORDER BY id'.format(
+            ', '.join(Attribute._fields))):
+        attribute_ids.append(id)
+        attributes += ATTRIBUTE_RECORD.pack(*(string(value) for value in row[:8]),
+                *(integer(value) for value in row[8:]))
+
+    string_data = bytearray()
+    string_offsets = [ 0 ]
+    for value in strings:
+        string_data += value.encode('utf-8')
+        string_offsets.append(len(string_data))
+
+    sections = [
+        struct.pack('<{}i'.format(len(item_ids)), *item_ids),
+        items,
+        struct.pack('<{}i'.format(len(attribute_ids)), *attribute_ids),
+        attributes,
+        item_attributes,
+        struct.pack('<{}I'.format(len(string_offsets)), *string_offsets),
+        string_data,
+    ]
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+
+    # not a private mkstemp() file, the snapshot is read by other users like the database
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, *offsets))
+            for section in sections:
+                f.write(section)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+class Snapshot:
+    '''
+    A memory-mapped snapshot written by write_snapshot().  Opening it only reads the header;
+    records are unpacked when looked up, by a binary search over the ids.
+    '''
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, *offsets = HEADER.unpack_from(self.mm)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.mm.close()
+            raise ValueError("'{}' is not a version {} TF2IDB snapshot".format(path,
+                    SNAPSHOT_VERSION))
+        offsets.append(len(self.mm))
+
+        view = memoryview(self.mm)
+        self.item_ids = view[offsets[0]:offsets[1]].cast('i')
+        self.items_offset = offsets[1]
+        self.attribute_ids = view[offsets[2]:offsets[3]].cast('i')
+        self.attributes_offset = offsets[3]
+        self.item_attributes_offset = offsets[4]
+        self.string_offsets = view[offsets[5]:offsets[6]].cast('I')
+        self.strings_offset = offsets[6]
+
+    def close(self):
+        for view in (self.item_ids, self.attribute_ids, self.string_offsets):
+            view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def string(self, index: int):
+        if index == NO_STRING:
+            return None
+        start = self.strings_offset + self.string_offsets[index]
+        end = self.strings_offset + self.string_offsets[index + 1]
+        return self.mm[start:end].decode('utf-8')
+
+    def _find(self, ids: memoryview, id: int):
+        i = bisect.bisect_left(ids, id)
+        return i if i < len(ids) and ids[i] == id else None
+
+    def _item_record(self, id: int):
+        i = self._find(self.item_ids, id)
+        if i is None:
+            return None
+        return ITEM_RECORD.unpack_from(self.mm, self.items_offset + i * ITEM_RECORD.size)
+
+    def item(self, id: int):
+        record = self._item_record(id)
+        if record is None:
+            return None
+        s = self.string
+        name, item_name, cls, slot, quality, min_ilevel, max_ilevel, model, *_ = record
+        return Item(s(name), s(item_name), s(cls), s(slot), s(quality),
+                None if min_ilevel == NO_INT else min_ilevel,
+                None if max_ilevel == NO_INT else max_ilevel, s(model))
+
+    def item_attributes(self, id: int):
+        '''
+        Returns a list of (attribute id, value) for an item, values being floats unless the
+        attribute is not numeric.
+        '''
+        record = self._item_record(id)
+        if record is None:
+            return []
+        start, count = record[-2:]
+        offset = self.item_attributes_offset + start * ITEM_ATTRIBUTE_RECORD.size
+        return [ (attribute, value if string == NO_STRING else self.string(string))
+                for attribute, string, value in ITEM_ATTRIBUTE_RECORD.iter_unpack(
+                self.mm[offset:offset + count * ITEM_ATTRIBUTE_RECORD.size]) ]
+
+    def attribute(self, id: int):
+        i = self._find(self.attribute_ids, id)
+        if i is None:
+            return None
+        record = ATTRIBUTE_RECORD.unpack_from(self.mm,
+                self.attributes_offset + i * ATTRIBUTE_RECORD.size)
+        return Attribute(*(self.string(index) for index in record[:8]),
+                *(None if value == NO_INT else value for value in record[8:]))
@@ -1,20 +1,156 @@
 #!/usr/bin/env python
 
 import vdf
+import snapshot
 import sqlite3
 import traceback
 import time
 import collections
+import collections.abc
 from collections import defaultdict
 import copy
+import hashlib
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+import pickle
+import tempfile
+import cProfile
+import sys
+import json
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is left out of the build stats
+    resource = None
 
 CLASSES_USABLE = [ 'scout', 'soldier', 'pyro', 'demoman', 'heavy', 'engineer',
         'medic', 'sniper', 'spy' ]
 
+# number of rows buffered per statement before they are written with executemany
+INSERT_BATCH_SIZE = 5000
+
+# connection settings used while loading the tables with fast_build, restored afterwards
+# (journal_mode stays on a rollback journal, so batches can still be rolled back)
+FAST_BUILD_PRAGMAS = [ ('journal_mode', 'MEMORY'), ('synchronous', 'OFF'),
+        ('cache_size', '-65536'), ('temp_store', 'MEMORY') ]
+
+# FAST_BUILD_PRAGMAS only applied to a database with no tables in use: a crash while they are
+# set can corrupt the database, which servers reading it would not survive
+FAST_BUILD_UNSAFE_PRAGMAS = [ 'journal_mode', 'synchronous' ]
+
+# bump whenever the tables or the rows written for an item change, so that incremental builds
+# on a database made by an older version start over
+SCHEMA_VERSION = 2
+
+# attribute types stored as numbers in tf2idb_item_attributes.numeric_value, with the function
+# converting their values; attributes of other types (string, account_info, ...) get NULL
+NUMERIC_ATTRIBUTE_TYPES = { 'float': float, 'integer': float, 'uint64': int }
+
+# tables holding rows derived from a single item, keyed by its defindex in the 'id' column
+ITEM_TABLES = [ 'tf2idb_item', 'tf2idb_class', 'tf2idb_item_attributes', 'tf2idb_equip_regions',
+        'tf2idb_capabilities', 'tf2idb_item_rarities' ]
+
+# sections whose content feeds into the rows of every item; a change forces a full rebuild
+ITEM_CONTEXT_SECTIONS = [ 'attributes', 'rarities', 'item_collections' ]
+
+# bump whenever load_sections() or resolve_items() produce different data, so that parse caches
+# written by an older version are ignored
+PARSE_CACHE_VERSION = 1
+
+# default upper bound for the total size of a parse cache directory, in bytes
+PARSE_CACHE_SIZE = 256 * 1024 * 1024
+
+# number of items handed to an ItemWorker at a time
+ITEM_CHUNK_SIZE = 256
+
+# items_game sections kept in memory while the items are streamed
+RESIDENT_SECTIONS = [ 'qualities', 'rarities', 'prefabs', 'attributes', 'equip_conflicts',
+        'item_collections', 'attribute_controlled_attached_particles' ]
+
+# indexes created on the tables once they are loaded, as (table, columns), if the build made the
+# table; besides the primary keys, they cover the lookups of the statements in
+# QUERY_PLAN_STATEMENTS
+INDEXES = [
+    ('tf2idb_item_attributes', [ 'attribute', 'numeric_value' ]),
+    ('tf2idb_item_attributes', [ 'id', 'attribute', 'value' ]),
+    ('tf2idb_class', [ 'class' ]),
+    ('tf2idb_class', [ 'id', 'class', 'slot' ]),
+    ('tf2idb_item', [ 'slot' ]),
+    ('tf2idb_equip_conflicts', [ 'region', 'name' ]),
+    ('tf2idb_enums', [ 'kind', 'name' ]),
+]
+
+# the statements prepared by tf2idb.sp; none of them may scan a whole table
+QUERY_PLAN_STATEMENTS = [
+    "SELECT class FROM tf2idb_item WHERE id=?",
+    "SELECT name FROM tf2idb_item WHERE id=?",
+    "SELECT quality FROM tf2idb_item WHERE id=?",
+    "SELECT min_ilevel,max_ilevel FROM tf2idb_item WHERE id=?",
+    "SELECT attribute,value FROM tf2idb_item_attributes WHERE id=?",
+    "SELECT model_player FROM tf2idb_item WHERE id=?",
+    "SELECT region FROM tf2idb_equip_regions WHERE id=?",
+    "SELECT a.name FROM tf2idb_equip_conflicts a JOIN tf2idb_equip_conflicts b ON a.name=b.name WHERE a.region=? AND b.region=?",
+    "SELECT attribute FROM tf2idb_item a JOIN tf2idb_item_attributes b ON a.id=b.id WHERE a.id=? AND attribute=?",
+    "SELECT slot FROM tf2idb_class WHERE id=? AND (class=? OR class='all')",
+    "SELECT class FROM tf2idb_class WHERE id=?",
+    "SELECT name FROM tf2idb_attributes WHERE id=?",
+    "SELECT attribute_class FROM tf2idb_attributes WHERE id=?",
+    "SELECT attribute_type FROM tf2idb_attributes WHERE id=?",
+    "SELECT description_string FROM tf2idb_attributes WHERE id=?",
+    "SELECT description_format FROM tf2idb_attributes WHERE id=?",
+    "SELECT effect_type FROM tf2idb_attributes WHERE id=?",
+    "SELECT armory_desc FROM tf2idb_attributes WHERE id=?",
+    "SELECT apply_tag_to_item_definition FROM tf2idb_attributes WHERE id=?",
+]
+
+# the lists of rows of the other item tables included in a tf2idb_item_loadout entry, as
+# (key, query); the queries select the defindex first and sort by it
+LOADOUT_QUERIES = [
+    ('classes', 'SELECT id, class, slot FROM new_tf2idb_class ORDER BY id, class'),
+    ('attributes', 'SELECT id, attribute, COALESCE(numeric_value, value) FROM new_tf2idb_item_attributes ORDER BY id, attribute'),
+    ('equip_regions', 'SELECT id, region FROM new_tf2idb_equip_regions ORDER BY id, region'),
+    ('capabilities', 'SELECT id, capability FROM new_tf2idb_capabilities ORDER BY id, capability'),
+    ('rarity', 'SELECT id, rarity, collection FROM new_tf2idb_item_rarities ORDER BY id'),
+]
+
+# columns of the tf2idb_item_search FTS5 table, keyed by the item defindex (rowid); '_' is a
+# token separator so that names like TF_WEAPON_SCATTERGUN are split into words
+SEARCH_COLUMNS = [ 'name', 'item_name', 'localized' ]
+
+# prefix lengths indexed by tf2idb_item_search, prefix queries longer than these fall back to a
+# range scan of the full-token index
+SEARCH_PREFIXES = '1 2 3'
+
+# bump whenever the layout of delta files changes
+DELTA_VERSION = 1
+
+# tables left out of delta files: build bookkeeping, and the search index which is derived from
+# tf2idb_item
+DELTA_SKIPPED_TABLES = [ 'tf2idb_build_hashes', 'tf2idb_item_search' ]
+
+# text columns stored as integer codes with coded_enums, as (table, column, kind); the codes of
+# each kind are listed in tf2idb_enums
+CODED_COLUMNS = [
+    ('tf2idb_item', 'class', 'item_class'),
+    ('tf2idb_item', 'slot', 'slot'),
+    ('tf2idb_item', 'quality', 'quality'),
+    ('tf2idb_item', 'tool_type', 'tool_type'),
+    ('tf2idb_class', 'class', 'player_class'),
+    ('tf2idb_class', 'slot', 'slot'),
+    ('tf2idb_capabilities', 'capability', 'capability'),
+]
+
 class ItemParseError(Exception):
     def __init__(self, defindex):
         self.defindex = int(defindex)
         Exception.__init__(self, 'Item parsing error occurred at defindex {}'.format(defindex))
+    
+    def __reduce__(self):
+        # keeps the defindex when raised in a worker process
+        return (ItemParseError, (self.defindex,))
 
 #https://gist.github.com/angstwad/bf22d1822c38a92ec0a9
 def dict_merge(dct, merge_dct):
@@ -29,17 +165,24 @@ def dict_merge(dct, merge_dct):
     for k, v in merge_dct.items():
         if (k == 'used_by_classes' or k == 'model_player_per_class'):    #handles Demoman vs demoman... Valve pls
             v = dict((k2.lower(), v2) for k2, v2 in v.items())
-        if (k in dct and isinstance(dct[k], dict) and isinstance(v, collections.Mapping)):
+        if (k in dct and isinstance(dct[k], dict) and isinstance(v, collections.abc.Mapping)):
             dict_merge(dct[k], v)
         else:
             dct[k] = copy.deepcopy(v)
 
-def resolve_prefabs(item, prefabs):
-    # generate list of prefabs
-    prefab_list = item.get('prefab', '').split()
+def expand_prefabs(prefab: str, prefabs: dict):
+    '''
+    Returns the list of prefabs named in a 'prefab' value, followed by the prefabs they use.
+    '''
+    prefab_list = prefab.split()
     for prefab in prefab_list:
         subprefabs = prefabs[prefab].get('prefab', '').split()
         prefab_list.extend(p for p in subprefabs if p not in prefab_list)
+    return prefab_list
+
+def resolve_prefabs(item, prefabs):
+    # generate list of prefabs
+    prefab_list = expand_prefabs(item.get('prefab', ''), prefabs)
     
     # iterate over prefab list and merge, nested prefabs first
     # TODO make sure this is the same behavior the engine uses
@@ -50,6 +193,64 @@ def resolve_prefabs(item, prefabs):
     dict_merge(result, item)
     return result, prefab_list
 
+def dict_overlay(base, overlay):
+    '''
+    Returns the result of merging ``overlay`` into ``base`` the same way dict_merge() does,
+    without modifying either of them.  Only the dicts along merged keys are copied, everything
+    else is shared with ``base`` and ``overlay``, so the result must be treated as read-only.
+    '''
+    result = dict(base)
+    for k, v in overlay.items():
+        if (k == 'used_by_classes' or k == 'model_player_per_class'):
+            v = dict((k2.lower(), v2) for k2, v2 in v.items())
+        if (k in result and isinstance(result[k], dict) and isinstance(v, collections.abc.Mapping)):
+            result[k] = dict_overlay(result[k], v)
+        else:
+            result[k] = v
+    return result
+
+class PrefabResolver:
+    '''
+    Equivalent to resolve_prefabs(), but the prefab list and merged prefabs for each distinct
+    'prefab' value are only computed once.  Items are then overlaid on the cached result with
+    dict_overlay(), so the resolved items share structure and must not be modified.
+    '''
+    def __init__(self, prefabs: dict):
+        self.prefabs = prefabs
+        self.chains = {}
+
+    def chain(self, prefab: str):
+        '''
+        Returns the (merged prefabs, prefab list) pair for the given 'prefab' value.
+        '''
+        if not prefab in self.chains:
+            prefab_list = expand_prefabs(prefab, self.prefabs)
+            base = {}
+            for p in reversed(prefab_list):
+                base = dict_overlay(base, self.prefabs[p])
+            self.chains[prefab] = (base, prefab_list)
+        return self.chains[prefab]
+
+    def resolve(self, item: dict):
+        base, prefab_list = self.chain(item.get('prefab', ''))
+        return dict_overlay(base, item), list(prefab_list)
+
+def attribute_number(value: str, atype: str):
+    '''
+    Returns an attribute value as a number if its type is one of NUMERIC_ATTRIBUTE_TYPES, None
+    otherwise or if it is not a number SQLite can hold.
+    '''
+    convert = NUMERIC_ATTRIBUTE_TYPES.get(atype)
+    if convert is None:
+        return None
+    try:
+        number = convert(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(number, int) and not -2**63 <= number < 2**63:
+        return None
+    return number
+
 def item_has_australium_support(defindex: int, properties: dict):
     '''
     Returns True if the specified item seems to have australium support.
@@ -73,7 +274,481 @@ def item_has_paintkit_support(defindex: int, properties: dict):
     '''
     return 'paintkit_base' in properties.get('prefab', '').split()
 
-def main(items_game: str, database_file: str):
+class ItemRowBuilder:
+    '''
+    Builds the rows written for a resolved item, as a dict of row tuples keyed by table.
+    '''
+    item_defaults = {'propername': 0, 'item_quality': ''}
+    prop_remap = {'class': 'item_class', 'slot': 'item_slot', 'quality': 'item_quality'}
+    
+    def __init__(self, attribute_type: dict, item_rarity: dict, merge_allclass: bool,
+            item_columns: list):
+        self.attribute_type = attribute_type
+        self.item_rarity = item_rarity
+        self.merge_allclass = merge_allclass
+        self.item_columns = item_columns
+    
+    def rows(self, id, i: dict):
+        try:
+            return self.build_rows(id, i)
+        except Exception as e:
+            raise ItemParseError(id) from e
+    
+    def build_rows(self, id, i: dict):
+        rows = {}
+        baseitem = 'baseitem' in i
+        
+        has_string_attribute = False
+        attribute_rows = []
+        for name,value in i.get('static_attrs', {}).items():
+            aid,atype = self.attribute_type[name.lower()]
+            if atype == 'string':
+                has_string_attribute = True
+            attribute_rows.append((id,aid,value,1,attribute_number(value,atype)))
+
+        for name,info in i.get('attributes', {}).items():
+            aid,atype = self.attribute_type[name.lower()]
+            if atype == 'string':
+                has_string_attribute = True
+            attribute_rows.append((id,aid,info['value'],0,attribute_number(info['value'],atype)))
+        rows['tf2idb_item_attributes'] = attribute_rows
+
+        tool = i.get('tool', {}).get('type')
+        model_player = i.get('model_player', None)
+        item_insert_values = {
+            'id': id, 'tool_type': tool, 'baseitem': baseitem, 'has_string_attribute': has_string_attribute, 'model_player': model_player
+        }
+        
+        item = { **self.item_defaults, **item_insert_values, **i }
+        rows['tf2idb_item'] = [ tuple(item.get(self.prop_remap.get(col, col))
+                for col in self.item_columns) ]
+
+        default_slot = i.get('item_slot', None)
+        used_classes = i.get('used_by_classes', {})
+        if self.merge_allclass and all(c in used_classes for c in CLASSES_USABLE):
+            # insert the 'all' keyword into tf2idb_class instead of a row for each class
+            rows['tf2idb_class'] = [ (id, 'all', default_slot) ]
+        else:
+            rows['tf2idb_class'] = [ (id, prof.lower(), val if val != '1' else default_slot)
+                    for prof, val in used_classes.items() ]
+
+        region_field = i.get('equip_region') or i.get('equip_regions')
+        if region_field:
+            if type(region_field) is str:
+                region_field = {region_field: 1}
+            rows['tf2idb_equip_regions'] = [ (id, region) for region in region_field.keys() ]
+
+        # capabilties
+        capabilities = [ (id, (capability if val != '0' else '!'+capability))
+                for capability, val in i.get('capabilities', {}).items() ]
+        
+        # custom extended capabilities
+        if item_has_australium_support(int(id), i):
+            capabilities.append((id, 'supports_australium'))
+        if item_has_paintkit_support(int(id), i):
+            capabilities.append((id, 'can_apply_paintkit'))
+        rows['tf2idb_capabilities'] = capabilities
+        
+        # item rarity
+        if i['name'] in self.item_rarity:
+            collection, rarity = self.item_rarity[ i['name'] ]
+            rows['tf2idb_item_rarities'] = [ (id, rarity, collection) ]
+        
+        return rows
+
+class ItemWorker:
+    '''
+    Turns a chunk of (defindex, properties) pairs from iter_items() into a list of (defindex,
+    hash, rows) with rows from ItemRowBuilder, or None for items whose hash matches the one in
+    ``previous_items``.  Items rejected by ``item_filter`` get a hash of None.  Instances are
+    sent to the worker processes when parsing with multiple jobs.
+    '''
+    def __init__(self, prefabs: dict, prefab_hashes: dict, builder: ItemRowBuilder,
+            previous_items: dict = None, item_filter = None):
+        self.resolver = PrefabResolver(prefabs)
+        self.prefab_hashes = prefab_hashes
+        self.builder = builder
+        self.previous_items = previous_items
+        self.item_filter = item_filter
+    
+    def unchanged(self, id, item_hash: str):
+        return self.previous_items is not None and self.previous_items.get(id) == item_hash
+    
+    def build(self, id, item_hash: str, i: dict):
+        if i is None:
+            return id, item_hash, None
+        if self.item_filter is not None and not self.item_filter(id, i):
+            return id, None, None
+        return id, item_hash, self.builder.rows(id, i)
+    
+    def __call__(self, chunk: list):
+        return [ self.build(*item) for item in resolve_items(chunk, self.resolver,
+                self.prefab_hashes, self.unchanged) ]
+
+item_worker = None
+
+def init_item_worker(worker: ItemWorker):
+    global item_worker
+    item_worker = worker
+
+def run_item_worker(chunk: list):
+    return item_worker(chunk)
+
+def imap_window(pool: multiprocessing.pool.Pool, func, iterable, window: int):
+    '''
+    Like pool.imap(), but keeps at most ``window`` tasks in flight instead of queueing all of
+    ``iterable`` up front, so the input is read only as fast as the results are consumed.
+    '''
+    pending = collections.deque()
+    for value in iterable:
+        pending.append(pool.apply_async(func, (value,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def iter_chunks(iterable, size: int):
+    '''
+    Yields lists of up to ``size`` consecutive values from ``iterable``.
+    '''
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+def iter_loadouts(db: sqlite3.Connection):
+    '''
+    Yields (defindex, JSON) for every item in the new tables, the JSON object holding the
+    columns of the item and, for each of LOADOUT_QUERIES, its rows (without the defindex).  The
+    tables are read in defindex order side by side, so only one item is in memory at a time.
+    '''
+    items = db.execute('SELECT * FROM new_tf2idb_item ORDER BY id')
+    columns = [ column for column, *_ in items.description ]
+    groups = [ (key, itertools.groupby(db.execute(query), key = lambda row: row[0]))
+            for key, query in LOADOUT_QUERIES ]
+    heads = [ next(group, None) for _, group in groups ]
+    
+    for row in items:
+        id = row[0]
+        loadout = dict(zip(columns[1:], row[1:]))
+        for n, (key, group) in enumerate(groups):
+            while heads[n] is not None and heads[n][0] < id:
+                heads[n] = next(group, None)
+            if heads[n] is not None and heads[n][0] == id:
+                loadout[key] = [ list(r[1:]) if len(r) > 2 else r[1] for r in heads[n][1] ]
+            else:
+                loadout[key] = []
+        loadout['classes'] = dict(loadout['classes'])
+        loadout['rarity'] = loadout['rarity'][0] if loadout['rarity'] else None
+        yield id, json.dumps(loadout, separators = (',', ':'))
+
+def table_delta(dbc: sqlite3.Cursor, table: str, columns: list):
+    '''
+    Compares the rows of new_<table> with the ones of <table> and returns a dict listing the
+    keys (values of the first column) that were 'added', 'removed' or 'changed', or None if
+    the rows are the same.  The result is {'rebuilt': True} if there is no previous table (or
+    view) with the same columns to compare with.
+    '''
+    previous = { row[1] for row in dbc.execute('PRAGMA table_info("{}")'.format(table)) }
+    if previous != set(columns):
+        return { 'rebuilt': True }
+    
+    select = ', '.join('"{}"'.format(column) for column in columns)
+    key = columns[0]
+    
+    def keys(query):
+        return { k for k, in dbc.execute(query.format(key = key, select = select, table = table)) }
+    
+    differing = keys('SELECT DISTINCT "{key}" FROM (SELECT {select} FROM "new_{table}" EXCEPT '
+            'SELECT {select} FROM "{table}")')
+    differing |= keys('SELECT DISTINCT "{key}" FROM (SELECT {select} FROM "{table}" EXCEPT '
+            'SELECT {select} FROM "new_{table}")')
+    if not differing:
+        return None
+    
+    previous_keys = keys('SELECT DISTINCT "{key}" FROM "{table}"')
+    new_keys = keys('SELECT DISTINCT "{key}" FROM "new_{table}"')
+    return {
+        'added': sorted(differing - previous_keys),
+        'removed': sorted(differing - new_keys),
+        'changed': sorted(differing & previous_keys & new_keys),
+    }
+
+def write_delta(path: str, tables: dict):
+    '''
+    Writes the deltas of table_delta() keyed by table to a JSON file.  parse() writes it next to
+    the delta file before committing and moves it into place once committed, so a delta is never
+    lost or published for tables that were not.
+    '''
+    try:
+        with open(path, 'w') as f:
+            json.dump({ 'version': DELTA_VERSION, 'schema_version': SCHEMA_VERSION,
+                    'tables': tables }, f, separators = (',', ':'), sort_keys = True)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+def coded_view(table: str, columns: list):
+    '''
+    Returns the statement creating the view that shows a table of coded_enums under its usual
+    name, with the CODED_COLUMNS of the table turned back into text.
+    '''
+    coded = { column: kind for t, column, kind in CODED_COLUMNS if t == table }
+    select = []
+    joins = []
+    for column in columns:
+        if column in coded:
+            alias = 'e_' + column
+            select.append('{}.name AS "{}"'.format(alias, column))
+            joins.append('LEFT JOIN tf2idb_enums {a} ON {a}.kind=\'{}\' AND {a}.code=t."{}"'.format(
+                    coded[column], column, a = alias))
+        else:
+            select.append('t."{}"'.format(column))
+    return 'CREATE VIEW "{}" AS SELECT {} FROM "{}_coded" t {}'.format(table, ', '.join(select),
+            table, ' '.join(joins))
+
+def drop_table_or_view(dbc: sqlite3.Cursor, name: str):
+    row = dbc.execute('SELECT type FROM sqlite_master WHERE name=? AND type IN (\'table\', \'view\')',
+            (name,)).fetchone()
+    if row:
+        dbc.execute('DROP {} "{}"'.format(row[0].upper(), name))
+
+def region_conflict_masks(equip_conflicts: dict, regions):
+    '''
+    Interns equip regions to small integers and returns { region: (id, mask) }, where bit n of
+    mask is set if the region conflicts with the region with id n.  Two regions conflict if they
+    are listed in the same equip_conflicts entry, as in TF2IDB_DoRegionsConflict().
+    
+    :param equip_conflicts:  The equip_conflicts section of items_game.
+    :param regions:  Regions to include besides the ones listed in equip_conflicts.
+    '''
+    ids = { region: n for n, region in enumerate(sorted(set(regions).union(
+            *(group.keys() for group in equip_conflicts.values())))) }
+    masks = dict.fromkeys(ids, 0)
+    for group in equip_conflicts.values():
+        group_mask = 0
+        for region in group:
+            group_mask |= 1 << ids[region]
+        for region in group:
+            masks[region] |= group_mask
+    return { region: (ids[region], masks[region]) for region in ids }
+
+class QueryPlanError(Exception):
+    def __init__(self, statement, plan):
+        self.statement = statement
+        self.plan = plan
+        Exception.__init__(self, 'Statement scans a whole table: {} ({})'.format(statement,
+                '; '.join(plan)))
+
+def verify_query_plans(dbc: sqlite3.Cursor, statements = QUERY_PLAN_STATEMENTS):
+    '''
+    Raises QueryPlanError for the first statement that SQLite would run with a full table scan.
+    '''
+    for statement in statements:
+        plan = [ detail for *_, detail in dbc.execute('EXPLAIN QUERY PLAN ' + statement,
+                (None,) * statement.count('?')) ]
+        if any(detail.startswith('SCAN ') for detail in plan):
+            raise QueryPlanError(statement, plan)
+
+class PhaseTimer:
+    '''
+    Reports the consecutive phases of parse() to an observer, as observer(phase, stats) with the
+    wall and CPU time spent since the previous phase, the peak RSS of the process so far and,
+    where given, the number of items handled and the rows in the new tables.  Does nothing if the
+    observer is None.
+    '''
+    def __init__(self, observer, dbc: sqlite3.Cursor):
+        self.observer = observer
+        self.dbc = dbc
+        self.restart()
+    
+    def restart(self):
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+    
+    def end(self, phase: str, items: int = None, tables: list = ()):
+        if self.observer is None:
+            return
+        
+        stats = {
+            'seconds': time.perf_counter() - self.wall,
+            'cpu_seconds': time.process_time() - self.cpu,
+        }
+        if resource is not None:
+            stats['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if items is not None:
+            stats['items'] = items
+            stats['items_per_second'] = items / stats['seconds'] if stats['seconds'] else 0
+        if tables:
+            stats['rows'] = { table: self.dbc.execute('SELECT COUNT(*) FROM new_{}'.format(
+                    table)).fetchone()[0] for table in tables }
+        
+        self.observer(phase, stats)
+        self.restart()
+
+class BuildStats:
+    '''
+    A parse() observer that collects the stats of each phase and prints them as a table.
+    '''
+    def __init__(self):
+        self.phases = []
+    
+    def __call__(self, phase: str, stats: dict):
+        self.phases.append((phase, stats))
+    
+    def print(self, file = sys.stderr):
+        print('{:<10} {:>8} {:>8} {:>10} {:>10}  {}'.format('phase', 'wall', 'cpu', 'items/s',
+                'peak RSS', 'rows'), file = file)
+        for phase, stats in self.phases:
+            print('{:<10} {:>7.2f}s {:>7.2f}s {:>10} {:>7} MB  {}'.format(phase, stats['seconds'],
+                    stats['cpu_seconds'],
+                    '{:.0f}'.format(stats['items_per_second']) if 'items' in stats else '-',
+                    stats.get('peak_rss_kb', 0) // 1024,
+                    ', '.join('{} {}'.format(table, n) for table, n in stats.get('rows', {}).items())),
+                    file = file)
+
+def content_hash(*values):
+    '''
+    Returns a hex digest of the given parsed values, used to detect changes between builds.
+    '''
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+def load_build_hashes(db: sqlite3.Connection):
+    '''
+    Returns the hashes stored by the last build as a dict of dicts keyed by kind ('context',
+    'section', 'prefab' or 'item') and name, or None if the database has no complete build.
+    '''
+    dbc = db.cursor()
+    # with coded_enums some of the ITEM_TABLES are views, which can be copied from all the same
+    tables = { name for name, in dbc.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')") }
+    if not all(table in tables for table in ITEM_TABLES + ['tf2idb_build_hashes']):
+        return None
+    
+    hashes = defaultdict(dict)
+    for kind, name, value in dbc.execute('SELECT kind, name, hash FROM tf2idb_build_hashes'):
+        hashes[kind][name] = value
+    return hashes
+
+def load_sections(items_game: str, sections = RESIDENT_SECTIONS):
+    '''
+    Returns the requested top-level sections of items_game.txt as a dict, skipping everything
+    else (including the items) without building it.
+    '''
+    with open(items_game) as f:
+        return { key: value for _, key, value in vdf.iterparse(f, 1,
+                lambda path, key: not path or key in sections) }
+
+def load_localization(localization_file: str):
+    '''
+    Returns the tokens of a localization file (tf_english.txt) as a dict keyed by the lowercased
+    token, for looking up the '#'-prefixed item_name of an item.
+    '''
+    with open(localization_file, encoding = 'utf-16') as f:
+        return { key.lower(): value for _, key, value in vdf.iterparse(f, 2,
+                lambda path, key: len(path) != 1 or key.lower() == 'tokens') }
+
+def iter_items(items_game: str):
+    '''
+    Yields (defindex, properties) for each entry in the items section of items_game.txt, one at
+    a time.
+    '''
+    with open(items_game) as f:
+        yield from ((id, v) for _, id, v in vdf.iterparse(f, 2,
+                lambda path, key: len(path) != 1 or key == 'items'))
+
+def resolve_items(items, resolver: PrefabResolver, prefab_hashes: dict, skip = None):
+    '''
+    Yields (defindex, hash, properties) for each (defindex, properties) pair from iter_items(),
+    with its prefabs resolved.  The hash covers the item and every prefab it uses.  If
+    skip(defindex, hash) returns True, the item is not resolved and its properties are None.
+    '''
+    for id, v in items:
+        if id == 'default':
+            continue
+        
+        _, prefab_list = resolver.chain(v.get('prefab', ''))
+        item_hash = content_hash(v, [ prefab_hashes[p] for p in prefab_list ])
+        if skip is not None and skip(id, item_hash):
+            yield id, item_hash, None
+        else:
+            yield id, item_hash, resolver.resolve(v)[0]
+
+def load_items(items_game: str):
+    '''
+    Returns (sections, items) for items_game.txt, where sections is the result of load_sections()
+    and items is the list of (defindex, hash, properties) from resolve_items().  Can be passed to
+    parse() to build several databases from a single parse.
+    '''
+    data = load_sections(items_game)
+    prefab_hashes = { name: content_hash(prefab) for name, prefab in data['prefabs'].items() }
+    return data, list(resolve_items(iter_items(items_game), PrefabResolver(data['prefabs']),
+            prefab_hashes))
+
+def parse_cache_path(items_game: str, cache_dir: str):
+    '''
+    Returns the path of the parse cache entry for the current contents of items_game.txt.
+    '''
+    digest = hashlib.sha1()
+    with open(items_game, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return os.path.join(cache_dir, 'items_game-{}-v{}.pickle'.format(digest.hexdigest(),
+            PARSE_CACHE_VERSION))
+
+def load_parse_cache(items_game: str, cache_dir: str, cache_size = PARSE_CACHE_SIZE):
+    '''
+    Returns the result of load_items() for items_game.txt.
+    
+    The result is read from ``cache_dir`` if it was stored there for the same file contents and
+    cache version, otherwise the file is parsed and the result stored.  The least recently used
+    entries are removed to keep the directory under ``cache_size`` bytes.
+    '''
+    path = parse_cache_path(items_game, cache_dir)
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        os.utime(path)
+        return result
+    except FileNotFoundError:
+        pass
+    except Exception:
+        # unreadable or truncated entry, replace it
+        os.remove(path)
+    
+    result = load_items(items_game)
+    
+    # write to a temporary file first so a concurrent reader never sees a partial entry
+    os.makedirs(cache_dir, exist_ok = True)
+    fd, temp_path = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    
+    prune_parse_cache(cache_dir, cache_size)
+    return result
+
+def prune_parse_cache(cache_dir: str, cache_size = PARSE_CACHE_SIZE):
+    '''
+    Removes the least recently used parse cache entries until the rest fit in ``cache_size``
+    bytes.  The most recent entry is always kept.
+    '''
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('items_game-') and name.endswith('.pickle'):
+            st = os.stat(os.path.join(cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    entries.sort(reverse = True)
+    
+    total = 0
+    for n, (_, size, name) in enumerate(entries):
+        total += size
+        if n and total > cache_size:
+            os.remove(os.path.join(cache_dir, name))
+
+def main(items_game: str, database_file: str, **kwargs):
     '''
     Legacy interface for calling tf2idb.parse()
     (The new function call lets you pass in a database instead.)
@@ -81,11 +756,124 @@ def main(items_game: str, database_file: str):
     :param items_game:  Path to the items_game.txt file from TF2.
     :param database_file:  Path to a database file.  This file will be opened and closed in the
     process.
+    :param kwargs:  Passed on to parse().
     '''
     with sqlite3.connect(database_file) as db:
-        parse(items_game, db)
+        parse(items_game, db, **kwargs)
 
-def parse(items_game: str, db: sqlite3.Connection, merge_allclass = True):
+def publish(items_game: str, database_file: str, wal = False, **kwargs):
+    '''
+    Builds the database into a separate file next to ``database_file`` and atomically replaces
+    ``database_file`` with it once it is complete, so readers never wait on the build or see a
+    partly built database.  Connections opened before the replacement keep reading the previous
+    file until they are reopened.  Readers should open the database read-only; in WAL mode a
+    -wal file written to by them would not belong to the new file.
+    
+    :param items_game:  Path to the items_game.txt file from TF2.
+    :param database_file:  Path to the database file to replace.
+    :param wal:  Whether or not to publish the database in WAL journal mode.
+    :param kwargs:  Passed on to parse().  An incremental build, or one writing a delta file,
+    starts from a copy of ``database_file``.  The snapshot and delta files are replaced right
+    after the database, so they never belong to a database that was not published.
+    '''
+    temp_file = database_file + '.publish'
+    snapshot_file = kwargs.pop('snapshot_file', None)
+    temp_snapshot = snapshot_file + '.publish' if snapshot_file else None
+    delta_file = kwargs.pop('delta_file', None)
+    temp_delta = delta_file + '.publish' if delta_file else None
+    for path in (temp_file, temp_file + '-journal', temp_file + '-wal', temp_file + '-shm',
+            temp_snapshot, temp_delta):
+        if path and os.path.exists(path):
+            os.remove(path)
+    
+    db = sqlite3.connect(temp_file)
+    try:
+        if (kwargs.get('incremental') or delta_file) and os.path.isfile(database_file):
+            source = sqlite3.connect(database_file)
+            try:
+                source.backup(db)
+            finally:
+                source.close()
+        
+        parse(items_game, db, private = True, snapshot_file = temp_snapshot,
+                delta_file = temp_delta, **kwargs)
+        
+        # finished on a new connection, checkpointing the one that built the tables after
+        # switching it to WAL fails with a lock error
+        db.close()
+        db = sqlite3.connect(temp_file)
+        dbc = db.cursor()
+        dbc.execute('PRAGMA optimize')
+        verify_query_plans(dbc)
+        dbc.execute('PRAGMA journal_mode = {}'.format('WAL' if wal else 'DELETE')).fetchall()
+        if wal:
+            dbc.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        db.close()
+        
+        os.replace(temp_file, database_file)
+        if temp_snapshot:
+            os.replace(temp_snapshot, snapshot_file)
+        if temp_delta:
+            os.replace(temp_delta, delta_file)
+    except BaseException:
+        db.close()
+        for path in (temp_file, temp_snapshot, temp_delta):
+            if path and os.path.exists(path):
+                os.remove(path)
+        raise
+
+# options of --target, as the parse() argument they set
+TARGET_OPTIONS = {
+    'no-merge-allclass': ('merge_allclass', False),
+    'loadout': ('loadout', True),
+    'coded-enums': ('coded_enums', True),
+    'search': ('search', True),
+    'snapshot': ('snapshot', True),
+    'publish': ('publish', True),
+}
+
+# the parsed items_game.txt shared by the processes of build_targets()
+fanout_parsed = None
+
+def init_fanout_worker(parsed: tuple):
+    global fanout_parsed
+    fanout_parsed = parsed
+
+def run_fanout_target(items_game: str, database_file: str, options: dict):
+    options = dict(options)
+    build = publish if options.pop('publish', False) else main
+    build(items_game, database_file, parsed = fanout_parsed, **options)
+
+def build_targets(items_game: str, targets: list, processes = None, cache_dir = None,
+        cache_size = PARSE_CACHE_SIZE):
+    '''
+    Builds several databases from a single parse of items_game.txt.  The items are resolved
+    once, then every target is built in its own process, the processes sharing the parsed data
+    and writing their databases at the same time.
+    
+    :param items_game:  Path to the items_game.txt file from TF2.
+    :param targets:  A list of (database file, options), options being a dict of arguments for
+    parse() (merge_allclass, loadout, item_filter, ...) which may also set 'publish' to build
+    the target with publish().
+    :param processes:  The number of targets built at a time, by default one per CPU.
+    :param cache_dir:  A directory to cache the parsed items_game.txt in, see load_parse_cache().
+    :param cache_size:  The size limit of the cache directory, in bytes.
+    '''
+    if cache_dir:
+        parsed = load_parse_cache(items_game, cache_dir, cache_size)
+    else:
+        parsed = load_items(items_game)
+    
+    processes = min(len(targets), processes or os.cpu_count() or 1)
+    with multiprocessing.Pool(processes, init_fanout_worker, (parsed,)) as pool:
+        pool.starmap(run_fanout_target, [ (items_game, database_file, options)
+                for database_file, options in targets ])
+
+def parse(items_game: str, db: sqlite3.Connection, merge_allclass = True, fast_build = False,
+        vacuum = True, incremental = False, cache_dir = None, cache_size = PARSE_CACHE_SIZE,
+        jobs = 1, observer = None, profile = None, snapshot_file = None, loadout = False,
+        coded_enums = False, wal = False, parsed = None, item_filter = None, search = False,
+        localization_file = None, delta_file = None, private = False):
     """
     Parses items_game.txt into a database format usable by TF2IDB.
     
@@ -93,244 +881,596 @@ def parse(items_game: str, db: sqlite3.Connection, merge_allclass = True):
     :param db:  An SQLite3 connection.
     :param merge_allclass:  Whether or not items designated as usable by every class should use
     the 'all' keyword.  Defaults to True.  Set to false if using a different branch of TF2IDB.
+    :param fast_build:  Whether or not to load the tables with FAST_BUILD_PRAGMAS applied to the
+    connection.  The previous settings are restored once the tables are committed, or the build
+    failed.  The FAST_BUILD_UNSAFE_PRAGMAS are left as they are when ``db`` already holds a
+    database, unless it is ``private``.
+    :param vacuum:  Whether or not to VACUUM the database after the build.  Defaults to True.
+    :param incremental:  Whether or not to reuse the item rows of the previous build in ``db``
+    for items whose content and prefabs did not change.  Falls back to a full build if there is
+    no previous build or anything shared by all items changed.
+    :param cache_dir:  A directory to cache the parsed and resolved items_game.txt in, see
+    load_parse_cache().  All items are kept in memory while building if this is set.
+    :param cache_size:  The size limit of the cache directory, in bytes.
+    :param jobs:  The number of processes resolving items and building their rows.  Rows are
+    still written in file order by this process, so the result does not depend on it.  Not used
+    when the items come from the parse cache.
+    :param observer:  A callable receiving the stats of each build phase, see PhaseTimer.
+    :param profile:  A file to write cProfile stats of the item loop to (readable with pstats).
+    :param snapshot_file:  A file to write a snapshot of the items and attributes to once the
+    database is built, see snapshot.write_snapshot().
+    :param loadout:  Whether or not to build tf2idb_item_loadout, holding everything about an
+    item as a JSON object keyed by defindex (see iter_loadouts()).  It is derived from the other
+    item tables, which stay as they are.
+    :param coded_enums:  Whether or not to store the CODED_COLUMNS as integer codes, listed in
+    tf2idb_enums.  The tables holding them are named *_coded and shown under their usual names
+    by views that turn the codes back into text, so existing queries keep working.  Codes are
+    kept from the previous build, new names get new codes.
+    :param wal:  Whether or not to switch the database to WAL journal mode, so that readers are
+    not blocked while the tables are written and swapped.  The WAL is checkpointed at the end.
+    :param parsed:  The result of load_items() for items_game.txt, used instead of reading the
+    file again.
+    :param item_filter:  A function called as item_filter(defindex, properties) with the
+    resolved properties of every item, leaving out the items it returns False for.  It has to be
+    picklable to be used with multiple jobs.  The item rows of a previous build are not reused
+    with a filter, as items left unchanged are not resolved.
+    :param search:  Whether or not to build tf2idb_item_search, an FTS5 index over the names of
+    the items for reader.Reader.search_items().
+    :param localization_file:  A localization file (tf_english.txt) to index the localized
+    names of the items from, see load_localization().
+    :param delta_file:  A file to write the changes since the previous build in ``db`` to once
+    the tables are committed, see table_delta() and write_delta().  Coded tables are compared by
+    their codes, a change of tf2idb_enums means their codes have to be reloaded.
+    :param private:  Whether or not ``db`` is a file nobody else reads, like the temporary file of
+    publish(), so that a crash while building with fast_build can not harm a live database.
     """
-    data = None
-    with open(items_game) as f:
-        data = vdf.parse(f)
-        data = data['items_game']
+    timer = PhaseTimer(observer, db.cursor())
+    
+    if parsed is not None:
+        data, items = parsed
+    elif cache_dir:
+        data, items = load_parse_cache(items_game, cache_dir, cache_size)
+    else:
+        data, items = load_sections(items_game), None
+    
+    # everything besides the item and its prefabs that the rows of an item depend on
+    section_hashes = { name: content_hash(data[name]) for name in RESIDENT_SECTIONS }
+    context_hash = content_hash(SCHEMA_VERSION, merge_allclass,
+            [ section_hashes[name] for name in ITEM_CONTEXT_SECTIONS ])
+    prefab_hashes = { name: content_hash(prefab) for name, prefab in data['prefabs'].items() }
+    
+    previous_hashes = load_build_hashes(db) if incremental and item_filter is None else None
+    if previous_hashes and previous_hashes['context'].get('items') == context_hash:
+        previous_items = previous_hashes['item']
+    else:
+        previous_items = None
 
     dbc = db.cursor()
+    timer.end('load')
     
-    created_tables = {}
-    
-    def init_table(name: str, columns: list, primary_key = None):
-        c = ', '.join(('"{}" {}'.format(k, v) for k, v in columns))
-        
-        if primary_key:
-            column_names = (column for column, *_ in columns)
-            if not all(key in column_names for key in primary_key):
-                raise ValueError("Primary key not a valid column in table '{}'".format(name))
-            c += ', PRIMARY KEY ({})'.format(', '.join( ('"{}"'.format(k)) for k in primary_key))
-        
-        query = 'CREATE TABLE "new_{}" ({})'.format(name, c)
-        
-        dbc.execute('DROP TABLE IF EXISTS new_{}'.format(name))
-        dbc.execute(query)
-        
-        created_tables[name] = [ column for column, *_ in columns ]
-    
-    def insert_dict(name: str, item: dict, prop_remap: dict = {}):
-        if not name in created_tables:
-            raise ValueError("Table '{}' does not exist")
-        
-        dbc.execute('INSERT INTO new_{name} ({cols}) VALUES ({args})'.format(
-                name = name,
-                cols = ','.join(created_tables[name]),
-                args = ','.join(':' + prop_remap.get(col, col) for col in created_tables[name])),
-                item)
-
-    init_table('tf2idb_class', [
-        ('id', 'INTEGER NOT NULL'), ('class', 'TEXT NOT NULL'), ('slot', 'TEXT')
-    ], primary_key = ('id', 'class'))
-    
-    init_table('tf2idb_item_attributes', [
-        ('id', 'INTEGER NOT NULL'), ('attribute', 'INTEGER NOT NULL'), ('value', 'TEXT NOT NULL'),
-        ('static', 'INTEGER')
-    ], primary_key = ('id', 'attribute'))
-    
-    init_table('tf2idb_item', [
-        ('id', 'INTEGER PRIMARY KEY NOT NULL'),
-        ('name', 'TEXT NOT NULL'),
-        ('item_name', 'TEXT'),
-        ('class', 'TEXT NOT NULL'),
-        ('slot', 'TEXT'),
-        ('quality', 'TEXT NOT NULL'),
-        ('tool_type', 'TEXT'),
-        ('min_ilevel', 'INTEGER'),
-        ('max_ilevel', 'INTEGER'),
-        ('baseitem', 'INTEGER'),
-        ('holiday_restriction', 'TEXT'),
-        ('has_string_attribute', 'INTEGER'),
-        ('propername', 'INTEGER'),
-        ('model_player', 'TEXT')
-    ])
-    
-    init_table('tf2idb_particles', [
-        ('id', 'INTEGER PRIMARY KEY NOT NULL'), ('name', 'TEXT NOT NULL'),
-        ('type', 'TEXT NOT NULL')
-    ])
-    
-    init_table('tf2idb_equip_conflicts', [
-        ('name', 'TEXT NOT NULL'), ('region', 'TEXT NOT NULL'),
-    ], primary_key = ('name', 'region'))
-    
-    init_table('tf2idb_equip_regions', [
-        ('id', 'INTEGER NOT NULL'), ('region', 'TEXT NOT NULL')
-    ], primary_key = ('id', 'region'))
-    
-    init_table('tf2idb_capabilities', [
-        ('id', 'INTEGER NOT NULL'), ('capability', 'TEXT NOT NULL')
-    ], primary_key = ('id', 'capability'))
-    
-    init_table('tf2idb_attributes', [
-        ('id', 'INTEGER PRIMARY KEY NOT NULL'),
-        ('name', 'TEXT NOT NULL'),
-        ('attribute_class', 'TEXT'),
-        ('attribute_type', 'TEXT'),
-        ('description_string', 'TEXT'),
-        ('description_format', 'TEXT'),
-        ('effect_type', 'TEXT'),
-        ('hidden', 'INTEGER'),
-        ('stored_as_integer', 'INTEGER'),
-        ('armory_desc', 'TEXT'),
-        ('is_set_bonus', 'INTEGER'),
-        ('is_user_generated', 'INTEGER'),
-        ('can_affect_recipe_component_name', 'INTEGER'),
-        ('apply_tag_to_item_definition', 'TEXT')
-    ])
-    
-    init_table('tf2idb_qualities', [
-        ('name', 'TEXT PRIMARY KEY NOT NULL'),
-        ('value', 'INTEGER NOT NULL')
-    ])
-    
-    init_table('tf2idb_rarities', [
-        ('name', 'TEXT PRIMARY KEY NOT NULL'),
-        ('value', 'INTEGER NOT NULL')
-    ])
-    
-    init_table('tf2idb_item_rarities', [
-        ('id', 'INTEGER PRIMARY KEY NOT NULL'),
-        ('rarity', 'INTEGER'),
-        ('collection', 'TEXT')
-    ])
-
-    nonce = int(time.time())
-    dbc.execute('CREATE INDEX "tf2idb_item_attributes_%i" ON "new_tf2idb_item_attributes" ("attribute" ASC)' % nonce)
-    dbc.execute('CREATE INDEX "tf2idb_class_%i" ON "new_tf2idb_class" ("class" ASC)' % nonce)
-    dbc.execute('CREATE INDEX "tf2idb_item_%i" ON "new_tf2idb_item" ("slot" ASC)' % nonce)
-
-    # qualities
-    dbc.executemany('INSERT INTO new_tf2idb_qualities (name, value) VALUES (?,?)',
-            ((qname, qdata['value']) for qname, qdata in data['qualities'].items()))
-
-    # particles
-    for particle_type, particle_list in data['attribute_controlled_attached_particles'].items():
-        dbc.executemany('INSERT INTO new_tf2idb_particles (id, name, type) VALUES (?,?,?)',
-                ((id, property['system'], particle_type) for id, property in particle_list.items()))
-
-    # attributes
-    attribute_type = {}
-    for k,v in data['attributes'].items():
-        atype = v.get('attribute_type', 'integer' if v.get('stored_as_integer') else 'float')
-        attribute_type[v['name'].lower()] = (k, atype)
-        insert_dict('tf2idb_attributes', defaultdict(lambda: None, { **{ 'id': k }, **v }))
-
-    # conflicts
-    for k,v in data['equip_conflicts'].items():
-        dbc.executemany('INSERT INTO new_tf2idb_equip_conflicts (name,region) VALUES (?,?)',
-                ((k, region) for region in v.keys()))
-
-    # rarities
-    db.executemany('INSERT INTO new_tf2idb_rarities (name, value) VALUES (?, ?)',
-            ((rname, rdata['value']) for rname, rdata in data['rarities'].items()))
-    
-    # item / rarity mapping
-    item_rarity = {}
-    for collection, collection_desc in data['item_collections'].items():
-        for rarity, itemlist in collection_desc['items'].items():
-            if rarity in data['rarities']:
-                for item in itemlist:
-                    item_rarity[item] = (collection, int(data['rarities'][rarity]['value']))
-    
-    # items
-    item_defaults = {'propername': 0, 'item_quality': ''}
+    if wal:
+        dbc.execute('PRAGMA journal_mode = WAL').fetchall()
     
-    for id,v in data['items'].items():
-        if id == 'default':
-            continue
+    in_use = not private and dbc.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='tf2idb_item'").fetchone() is not None
+    
+    saved_pragmas = {}
+    try:
+        if fast_build:
+            for pragma, value in FAST_BUILD_PRAGMAS:
+                if (wal and pragma == 'journal_mode' or
+                        in_use and pragma in FAST_BUILD_UNSAFE_PRAGMAS):
+                    continue
+                saved_pragmas[pragma] = dbc.execute('PRAGMA {}'.format(pragma)).fetchone()[0]
+                dbc.execute('PRAGMA {} = {}'.format(pragma, value))
         
-        i, prefabs_used = resolve_prefabs(v, data['prefabs'])
-        baseitem = 'baseitem' in i
+        created_tables = {}
+        
+        def init_table(name: str, columns: list, primary_key = None):
+            c = ', '.join(('"{}" {}'.format(k, v) for k, v in columns))
+            
+            if primary_key:
+                column_names = (column for column, *_ in columns)
+                if not all(key in column_names for key in primary_key):
+                    raise ValueError("Primary key not a valid column in table '{}'".format(name))
+                c += ', PRIMARY KEY ({})'.format(', '.join( ('"{}"'.format(k)) for k in primary_key))
+            
+            query = 'CREATE TABLE "new_{}" ({})'.format(name, c)
+            
+            dbc.execute('DROP TABLE IF EXISTS new_{}'.format(name))
+            dbc.execute(query)
+            
+            created_tables[name] = [ column for column, *_ in columns ]
+        
+        statements = {}
+        
+        def insert_statement(name: str, prop_remap: dict = None):
+            '''
+            Returns the cached INSERT statement for a table.  It takes positional parameters in column
+            order, or named parameters (renamed through prop_remap) if prop_remap is given.
+            '''
+            key = (name, tuple(prop_remap.items()) if prop_remap is not None else None)
+            if not key in statements:
+                if not name in created_tables:
+                    raise ValueError("Table '{}' does not exist".format(name))
+                
+                if prop_remap is None:
+                    args = ','.join('?' for col in created_tables[name])
+                else:
+                    args = ','.join(':' + prop_remap.get(col, col) for col in created_tables[name])
+                statements[key] = 'INSERT INTO new_{name} ({cols}) VALUES ({args})'.format(
+                        name = name, cols = ','.join(created_tables[name]), args = args)
+            return statements[key]
+        
+        def insert_dict(name: str, item: dict, prop_remap: dict = {}):
+            dbc.execute(insert_statement(name, prop_remap), item)
+        
+        pending_rows = defaultdict(list)
+        
+        def queue_rows(name: str, rows, prop_remap: dict = None):
+            '''
+            Buffers per-item rows, writing them out once INSERT_BATCH_SIZE rows are queued for the
+            statement.  The first value (or 'id') of each row must be the item defindex.
+            '''
+            statement = insert_statement(name, prop_remap)
+            pending = pending_rows[statement]
+            pending.extend(rows)
+            if len(pending) >= INSERT_BATCH_SIZE:
+                flush_rows(statement)
+        
+        def flush_rows(statement: str):
+            rows = pending_rows.pop(statement, [])
+            dbc.execute('SAVEPOINT insert_batch')
+            try:
+                dbc.executemany(statement, rows)
+            except sqlite3.Error:
+                # redo the batch one row at a time to find the item that caused the failure
+                dbc.execute('ROLLBACK TO insert_batch')
+                for row in rows:
+                    try:
+                        dbc.execute(statement, row)
+                    except sqlite3.Error as e:
+                        raise ItemParseError(row['id'] if isinstance(row, dict) else row[0]) from e
+                raise
+            dbc.execute('RELEASE insert_batch')
+        
+        init_table('tf2idb_class', [
+            ('id', 'INTEGER NOT NULL'), ('class', 'TEXT NOT NULL'), ('slot', 'TEXT')
+        ], primary_key = ('id', 'class'))
+        
+        init_table('tf2idb_item_attributes', [
+            ('id', 'INTEGER NOT NULL'), ('attribute', 'INTEGER NOT NULL'), ('value', 'TEXT NOT NULL'),
+            ('static', 'INTEGER'), ('numeric_value', 'NUMERIC')
+        ], primary_key = ('id', 'attribute'))
+        
+        init_table('tf2idb_item', [
+            ('id', 'INTEGER PRIMARY KEY NOT NULL'),
+            ('name', 'TEXT NOT NULL'),
+            ('item_name', 'TEXT'),
+            ('class', 'TEXT NOT NULL'),
+            ('slot', 'TEXT'),
+            ('quality', 'TEXT NOT NULL'),
+            ('tool_type', 'TEXT'),
+            ('min_ilevel', 'INTEGER'),
+            ('max_ilevel', 'INTEGER'),
+            ('baseitem', 'INTEGER'),
+            ('holiday_restriction', 'TEXT'),
+            ('has_string_attribute', 'INTEGER'),
+            ('propername', 'INTEGER'),
+            ('model_player', 'TEXT')
+        ])
+        
+        init_table('tf2idb_particles', [
+            ('id', 'INTEGER PRIMARY KEY NOT NULL'), ('name', 'TEXT NOT NULL'),
+            ('type', 'TEXT NOT NULL')
+        ])
+        
+        init_table('tf2idb_equip_conflicts', [
+            ('name', 'TEXT NOT NULL'), ('region', 'TEXT NOT NULL'),
+        ], primary_key = ('name', 'region'))
+        
+        init_table('tf2idb_equip_regions', [
+            ('id', 'INTEGER NOT NULL'), ('region', 'TEXT NOT NULL')
+        ], primary_key = ('id', 'region'))
+        
+        init_table('tf2idb_capabilities', [
+            ('id', 'INTEGER NOT NULL'), ('capability', 'TEXT NOT NULL')
+        ], primary_key = ('id', 'capability'))
+        
+        init_table('tf2idb_attributes', [
+            ('id', 'INTEGER PRIMARY KEY NOT NULL'),
+            ('name', 'TEXT NOT NULL'),
+            ('attribute_class', 'TEXT'),
+            ('attribute_type', 'TEXT'),
+            ('description_string', 'TEXT'),
+            ('description_format', 'TEXT'),
+            ('effect_type', 'TEXT'),
+            ('hidden', 'INTEGER'),
+            ('stored_as_integer', 'INTEGER'),
+            ('armory_desc', 'TEXT'),
+            ('is_set_bonus', 'INTEGER'),
+            ('is_user_generated', 'INTEGER'),
+            ('can_affect_recipe_component_name', 'INTEGER'),
+            ('apply_tag_to_item_definition', 'TEXT')
+        ])
+        
+        init_table('tf2idb_qualities', [
+            ('name', 'TEXT PRIMARY KEY NOT NULL'),
+            ('value', 'INTEGER NOT NULL')
+        ])
+        
+        init_table('tf2idb_rarities', [
+            ('name', 'TEXT PRIMARY KEY NOT NULL'),
+            ('value', 'INTEGER NOT NULL')
+        ])
+        
+        init_table('tf2idb_item_rarities', [
+            ('id', 'INTEGER PRIMARY KEY NOT NULL'),
+            ('rarity', 'INTEGER'),
+            ('collection', 'TEXT')
+        ])
+        
+        init_table('tf2idb_equip_region_masks', [
+            ('region', 'TEXT PRIMARY KEY NOT NULL'), ('id', 'INTEGER NOT NULL'), ('mask', 'BLOB NOT NULL')
+        ])
+        
+        init_table('tf2idb_equip_region_conflicts', [
+            ('region', 'TEXT NOT NULL'), ('other', 'TEXT NOT NULL')
+        ], primary_key = ('region', 'other'))
+        
+        if loadout:
+            init_table('tf2idb_item_loadout', [
+                ('id', 'INTEGER PRIMARY KEY NOT NULL'), ('loadout', 'TEXT NOT NULL')
+            ])
+        
+        init_table('tf2idb_build_hashes', [
+            ('kind', 'TEXT NOT NULL'), ('name', 'TEXT NOT NULL'), ('hash', 'TEXT NOT NULL')
+        ], primary_key = ('kind', 'name'))
+        
+        # start from the item rows of the previous build, changed items are replaced below
+        if previous_items is not None:
+            for table in ITEM_TABLES:
+                dbc.execute('INSERT INTO new_{table} ({cols}) SELECT {cols} FROM {table}'.format(
+                        table = table, cols = ','.join(created_tables[table])))
+
+        # qualities
+        dbc.executemany('INSERT INTO new_tf2idb_qualities (name, value) VALUES (?,?)',
+                ((qname, qdata['value']) for qname, qdata in data['qualities'].items()))
+
+        # particles
+        for particle_type, particle_list in data['attribute_controlled_attached_particles'].items():
+            dbc.executemany('INSERT INTO new_tf2idb_particles (id, name, type) VALUES (?,?,?)',
+                    ((id, property['system'], particle_type) for id, property in particle_list.items()))
+
+        # attributes
+        attribute_type = {}
+        for k,v in data['attributes'].items():
+            atype = v.get('attribute_type', 'integer' if v.get('stored_as_integer') else 'float')
+            attribute_type[v['name'].lower()] = (k, atype)
+            insert_dict('tf2idb_attributes', defaultdict(lambda: None, { **{ 'id': k }, **v }))
+
+        # conflicts
+        for k,v in data['equip_conflicts'].items():
+            dbc.executemany('INSERT INTO new_tf2idb_equip_conflicts (name,region) VALUES (?,?)',
+                    ((k, region) for region in v.keys()))
 
+        # rarities
+        db.executemany('INSERT INTO new_tf2idb_rarities (name, value) VALUES (?, ?)',
+                ((rname, rdata['value']) for rname, rdata in data['rarities'].items()))
+        
+        # item / rarity mapping
+        item_rarity = {}
+        for collection, collection_desc in data['item_collections'].items():
+            for rarity, itemlist in collection_desc['items'].items():
+                if rarity in data['rarities']:
+                    for item in itemlist:
+                        item_rarity[item] = (collection, int(data['rarities'][rarity]['value']))
+        
+        timer.end('sections', tables = [ 'tf2idb_qualities', 'tf2idb_particles', 'tf2idb_attributes',
+                'tf2idb_equip_conflicts', 'tf2idb_rarities' ])
+        
+        # items
+        profiler = cProfile.Profile() if profile else None
+        if profiler:
+            profiler.enable()
+        
+        item_hashes = {}
+        builder = ItemRowBuilder(attribute_type, item_rarity, merge_allclass,
+                created_tables['tf2idb_item'])
+        
+        worker = ItemWorker(data['prefabs'], prefab_hashes, builder, previous_items, item_filter)
+        pool = None
+        
+        if items is not None:
+            # already resolved by load_items() or the parse cache
+            results = ([ worker.build(id, item_hash, None if worker.unchanged(id, item_hash) else i) ]
+                    for id, item_hash, i in items)
+        else:
+            chunks = iter_chunks(iter_items(items_game), ITEM_CHUNK_SIZE)
+            if jobs > 1:
+                pool = multiprocessing.Pool(jobs, init_item_worker, (worker,))
+                results = imap_window(pool, run_item_worker, chunks, jobs * 2)
+            else:
+                results = map(worker, chunks)
+        
         try:
-            has_string_attribute = False
-            for name,value in i.get('static_attrs', {}).items():
-                aid,atype = attribute_type[name.lower()]
-                if atype == 'string':
-                    has_string_attribute = True
-                dbc.execute('INSERT INTO new_tf2idb_item_attributes (id,attribute,value,static) VALUES (?,?,?,?)', (id,aid,value,1))
-
-            for name,info in i.get('attributes', {}).items():
-                aid,atype = attribute_type[name.lower()]
-                if atype == 'string':
-                    has_string_attribute = True
-                dbc.execute('INSERT INTO new_tf2idb_item_attributes (id,attribute,value,static) VALUES (?,?,?,?)', (id,aid,info['value'],0))
-
-            tool = i.get('tool', {}).get('type')
-            model_player = i.get('model_player', None)
-            item_insert_values = {
-                'id': id, 'tool_type': tool, 'baseitem': baseitem, 'has_string_attribute': has_string_attribute, 'model_player': model_player
-            }
+            for chunk in results:
+                for id, item_hash, rows in chunk:
+                    if item_hash is None:
+                        continue
+                    item_hashes[id] = item_hash
+                    if rows is None:
+                        continue
+                    if previous_items is not None and id in previous_items:
+                        for table in ITEM_TABLES:
+                            dbc.execute('DELETE FROM new_{} WHERE id=?'.format(table), (id,))
+                    for table, table_rows in rows.items():
+                        queue_rows(table, table_rows)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        for statement in list(pending_rows.keys()):
+            flush_rows(statement)
+        
+        # items that no longer exist
+        if previous_items is not None:
+            for id in previous_items.keys() - item_hashes.keys():
+                for table in ITEM_TABLES:
+                    dbc.execute('DELETE FROM new_{} WHERE id=?'.format(table), (id,))
+        
+        dbc.executemany('INSERT INTO new_tf2idb_build_hashes (kind, name, hash) VALUES (?,?,?)',
+                [ ('context', 'items', context_hash) ]
+                + [ ('section', name, value) for name, value in section_hashes.items() ]
+                + [ ('prefab', name, value) for name, value in prefab_hashes.items() ]
+                + [ ('item', name, value) for name, value in item_hashes.items() ])
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        timer.end('items', items = len(item_hashes), tables = ITEM_TABLES)
+        
+        # region conflicts, over every region used by an item or listed in equip_conflicts
+        region_masks = region_conflict_masks(data['equip_conflicts'], (region for region, in
+                dbc.execute('SELECT DISTINCT region FROM new_tf2idb_equip_regions').fetchall()))
+        regions_by_id = sorted(region_masks, key = lambda region: region_masks[region][0])
+        dbc.executemany('INSERT INTO new_tf2idb_equip_region_masks (region, id, mask) VALUES (?,?,?)',
+                ((region, id, mask.to_bytes((len(region_masks) + 7) // 8, 'little'))
+                for region, (id, mask) in region_masks.items()))
+        dbc.executemany('INSERT INTO new_tf2idb_equip_region_conflicts (region, other) VALUES (?,?)',
+                ((region, other) for region, (id, mask) in region_masks.items()
+                for n, other in enumerate(regions_by_id) if mask >> n & 1))
+        timer.end('regions', tables = [ 'tf2idb_equip_region_masks', 'tf2idb_equip_region_conflicts' ])
+        
+        if loadout:
+            dbc.executemany('INSERT INTO new_tf2idb_item_loadout (id, loadout) VALUES (?,?)',
+                    iter_loadouts(db))
+            timer.end('loadout', items = len(item_hashes), tables = [ 'tf2idb_item_loadout' ])
+        
+        if search:
+            tokens = load_localization(localization_file) if localization_file else {}
+            dbc.execute('CREATE VIRTUAL TABLE new_tf2idb_item_search USING fts5({}, '
+                    'tokenize = "unicode61 separators \'_\'", prefix = \'{}\')'.format(
+                    ', '.join(SEARCH_COLUMNS), SEARCH_PREFIXES))
+            created_tables['tf2idb_item_search'] = SEARCH_COLUMNS
+            dbc.executemany('INSERT INTO new_tf2idb_item_search (rowid, {}) VALUES (?,?,?,?)'.format(
+                    ', '.join(SEARCH_COLUMNS)), ((id, name, item_name,
+                    tokens.get(item_name[1:].lower()) if item_name and item_name[0] == '#' else None)
+                    for id, name, item_name in dbc.execute(
+                    'SELECT id, name, item_name FROM new_tf2idb_item').fetchall()))
+            dbc.execute("INSERT INTO new_tf2idb_item_search (new_tf2idb_item_search) VALUES ('optimize')")
+            timer.end('search', items = len(item_hashes), tables = [ 'tf2idb_item_search' ])
+        
+        coded_tables = []
+        if coded_enums:
+            init_table('tf2idb_enums', [
+                ('kind', 'TEXT NOT NULL'), ('code', 'INTEGER NOT NULL'), ('name', 'TEXT NOT NULL')
+            ], primary_key = ('kind', 'code'))
             
-            insert_dict('tf2idb_item',
-                    defaultdict(lambda: None, { **item_defaults, **item_insert_values, **i }),
-                    prop_remap = {'class': 'item_class', 'slot': 'item_slot', 'quality': 'item_quality'})
-
-            default_slot = i.get('item_slot', None)
-            used_classes = i.get('used_by_classes', {})
-            if merge_allclass and all(c in used_classes for c in CLASSES_USABLE):
-                # insert the 'all' keyword into tf2idb_class instead of a row for each class
-                dbc.execute('INSERT INTO new_tf2idb_class (id, class, slot) VALUES (?, ?, ?)',
-                        (id, 'all', default_slot))
-            else:
-                dbc.executemany('INSERT INTO new_tf2idb_class (id,class,slot) VALUES (?,?,?)',
-                        ((id, prof.lower(), val if val != '1' else default_slot)
-                        for prof, val in used_classes.items()))
-
-            region_field = i.get('equip_region') or i.get('equip_regions')
-            if region_field:
-                if type(region_field) is str:
-                    region_field = {region_field: 1}
-                dbc.executemany('INSERT INTO new_tf2idb_equip_regions (id,region) VALUES (?,?)',
-                        ((id, region) for region in region_field.keys()))
-
-            # capabilties
-            dbc.executemany('INSERT INTO new_tf2idb_capabilities (id,capability) VALUES (?,?)',
-                    ((id, (capability if val != '0' else '!'+capability))
-                    for capability, val in i.get('capabilities', {}).items()))
+            enums = defaultdict(set)
+            for table, column, kind in CODED_COLUMNS:
+                enums[kind].update(name for name, in dbc.execute(
+                        'SELECT DISTINCT "{}" FROM new_{} WHERE "{}" IS NOT NULL'.format(column, table,
+                        column)))
             
-            # custom extended capabilities
-            if item_has_australium_support(int(id), i):
-                dbc.execute('INSERT INTO new_tf2idb_capabilities (id, capability) VALUES (?, ?)',
-                        (id, 'supports_australium'))
-            if item_has_paintkit_support(int(id), i):
-                dbc.execute('INSERT INTO new_tf2idb_capabilities (id, capability) VALUES (?, ?)',
-                        (id, 'can_apply_paintkit'))
+            # names keep the codes of the previous build, new names get codes after the highest
+            # previous one, so codes cached by readers stay valid and unchanged rows stay equal
+            codes = defaultdict(dict)
+            if dbc.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND "
+                    "name='tf2idb_enums'").fetchone():
+                for kind, code, name in dbc.execute('SELECT kind, code, name FROM tf2idb_enums'):
+                    codes[kind][name] = code
+            enum_rows = []
+            for kind, names in enums.items():
+                previous = codes[kind]
+                next_code = max(previous.values(), default = -1) + 1
+                for name in sorted(names):
+                    if name in previous:
+                        code = previous[name]
+                    else:
+                        code, next_code = next_code, next_code + 1
+                    enum_rows.append((kind, code, name))
+            dbc.executemany('INSERT INTO new_tf2idb_enums (kind, code, name) VALUES (?,?,?)',
+                    enum_rows)
             
-            # item rarity
-            if i['name'] in item_rarity:
-                dbc.execute('INSERT INTO new_tf2idb_item_rarities (id, collection, rarity) VALUES (?, ?, ?)',
-                        (id,) + item_rarity[ i['name'] ])
-        except Exception as e:
-            raise ItemParseError(id) from e
+            coded_tables = list(dict.fromkeys(table for table, *_ in CODED_COLUMNS))
+            for table in coded_tables:
+                coded = { column: kind for t, column, kind in CODED_COLUMNS if t == table }
+                sql = dbc.execute('SELECT sql FROM sqlite_master WHERE name=?',
+                        ('new_' + table,)).fetchone()[0]
+                for column in coded:
+                    sql = sql.replace('"{}" TEXT'.format(column), '"{}" INTEGER'.format(column))
+                dbc.execute(sql.replace('"new_{}"'.format(table), '"new_{}_coded"'.format(table), 1))
+                
+                columns = created_tables.pop(table)
+                dbc.execute('INSERT INTO "new_{}_coded" ({}) SELECT {} FROM new_{} t {}'.format(
+                        table, ', '.join('"{}"'.format(column) for column in columns),
+                        ', '.join('e_{}.code'.format(column) if column in coded else
+                        't."{}"'.format(column) for column in columns), table,
+                        ' '.join('LEFT JOIN new_tf2idb_enums e_{c} ON e_{c}.kind=\'{}\' AND '
+                        'e_{c}.name=t."{c}"'.format(kind, c = column) for column, kind in coded.items())))
+                dbc.execute('DROP TABLE new_{}'.format(table))
+                created_tables[table + '_coded'] = columns
+            timer.end('enums', tables = [ table + '_coded' for table in coded_tables ] + [ 'tf2idb_enums' ])
+        
+        # indexes are built once the data is in, which is cheaper than updating them on every insert
+        # index names do not change when a table is renamed, so the index of the table being
+        # replaced is dropped first to reuse its name (it would go with the table anyway)
+        for table, columns in INDEXES:
+            if table in coded_tables:
+                table += '_coded'
+            if not table in created_tables:
+                continue
+            name = '{}_{}'.format(table, '_'.join(columns))
+            dbc.execute('DROP INDEX IF EXISTS "{}"'.format(name))
+            dbc.execute('CREATE INDEX "{}" ON "new_{}" ({})'.format(name, table,
+                    ', '.join('"{}" ASC'.format(column) for column in columns)))
+        timer.end('indexes')
+        
+        if delta_file:
+            delta = {}
+            for table, columns in created_tables.items():
+                if table in DELTA_SKIPPED_TABLES:
+                    continue
+                changes = table_delta(dbc, table, columns)
+                if changes:
+                    delta[table] = changes
+            timer.end('delta')
+
+        # finalize tables
+        if not loadout:
+            # left over from an earlier build, it would not match the new items
+            dbc.execute('DROP TABLE IF EXISTS tf2idb_item_loadout')
+        if not search:
+            dbc.execute('DROP TABLE IF EXISTS tf2idb_item_search')
+        # views of coded_enums go first, renaming tables fails while a view is broken
+        for table in dict.fromkeys(table for table, *_ in CODED_COLUMNS):
+            drop_table_or_view(dbc, table)
+            if not coded_enums:
+                drop_table_or_view(dbc, table + '_coded')
+        if not coded_enums:
+            dbc.execute('DROP TABLE IF EXISTS tf2idb_enums')
+        for table in created_tables.keys():
+            drop_table_or_view(dbc, table)
+            dbc.execute('ALTER TABLE new_%s RENAME TO %s' % (table, table))
+        for table in coded_tables:
+            dbc.execute(coded_view(table, created_tables[table + '_coded']))
+
+        try:
+            verify_query_plans(dbc)
+        except QueryPlanError:
+            db.rollback()
+            raise
 
-    # finalize tables
-    for table in created_tables.keys():
-        dbc.execute('DROP TABLE IF EXISTS %s' % table)
-        dbc.execute('ALTER TABLE new_%s RENAME TO %s' % (table, table))
+        if delta_file:
+            write_delta(delta_file + '.tmp', delta)
+        
+        db.commit()
+        
+        if delta_file:
+            os.replace(delta_file + '.tmp', delta_file)
+    except BaseException:
+        # the journal settings below can only be restored outside of a transaction
+        db.rollback()
+        if delta_file and os.path.exists(delta_file + '.tmp'):
+            os.remove(delta_file + '.tmp')
+        raise
+    finally:
+        for pragma, value in saved_pragmas.items():
+            dbc.execute('PRAGMA {} = {}'.format(pragma, value))
+    timer.end('finalize')
+    
+    if vacuum:
+        dbc.execute('VACUUM')
+        timer.end('vacuum')
+    
+    if snapshot_file:
+        snapshot.write_snapshot(db, snapshot_file)
+        timer.end('snapshot')
+    
+    # the nested functions above keep the cursor alive, an unfinished statement on it would
+    # keep a lock on the database
+    dbc.close()
+    timer.dbc.close()
+    
+    if wal:
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
 
-    db.commit()
-    dbc.execute('VACUUM')
+def test(items = 3000):
+    '''
+    Checks that PrefabResolver.resolve() gives the same result as resolve_prefabs() for every
+    item of a synthetic items_game.txt written by benchmark.generate_items_game(), whose prefabs
+    and items use mixed-case used_by_classes.  Raises an exception on the first difference.
+    '''
+    import benchmark
+    
+    fd, path = tempfile.mkstemp(suffix = '.txt')
+    os.close(fd)
+    try:
+        benchmark.generate_items_game(path, items = items)
+        prefabs = load_sections(path)['prefabs']
+        resolver = PrefabResolver(prefabs)
+        count = 0
+        mixed_case = 0
+        for id, item in iter_items(path):
+            expected = resolve_prefabs(item, prefabs)
+            if resolver.resolve(item) != expected:
+                raise Exception("PrefabResolver differs from resolve_prefabs() for item "
+                        "{}".format(id))
+            if any(c != c.lower() for c in expected[0].get('used_by_classes', {})):
+                raise Exception("used_by_classes not lowercased for item {}".format(id))
+            mixed_case += 'Demoman' in item.get('used_by_classes', {})
+            count += 1
+        if count != items or not mixed_case:
+            raise Exception("items_game.txt fixture does not cover every case")
+    finally:
+        os.remove(path)
+    
+    return True
 
 if __name__ == "__main__":
     import argparse, os
     parser = argparse.ArgumentParser(
             description="Parses the items_game file into a SQLite database.",
-            usage='%(prog)s ITEMS DATABASE')
+            usage='%(prog)s [options] ITEMS DATABASE')
 
     parser.add_argument('items_game', metavar='ITEMS', help="path to items_game.txt")
     parser.add_argument('database', metavar='DATABASE', help="database to output to")
+    parser.add_argument('--fast', action='store_true',
+            help="relax journaling and syncing while the tables are loaded; only the cache "
+            "settings are changed when DATABASE already exists, unless built with --publish")
+    parser.add_argument('--no-vacuum', action='store_true', help="skip the final VACUUM")
+    parser.add_argument('--incremental', action='store_true',
+            help="only rebuild items that changed since the last build of DATABASE")
+    parser.add_argument('--jobs', metavar='N', type=int, default=1,
+            help="number of processes resolving items")
+    parser.add_argument('--stats', action='store_true',
+            help="print the time, memory and row counts of each build phase")
+    parser.add_argument('--profile', metavar='FILE',
+            help="write cProfile stats of the item loop to FILE")
+    parser.add_argument('--loadout', action='store_true',
+            help="also store every item as one JSON object in tf2idb_item_loadout")
+    parser.add_argument('--coded-enums', action='store_true',
+            help="store classes, slots, qualities, tool types and capabilities as integer codes")
+    parser.add_argument('--search', action='store_true',
+            help="also build tf2idb_item_search, a full-text index over the item names")
+    parser.add_argument('--localization', metavar='FILE',
+            help="index the localized item names of FILE (tf_english.txt) with --search")
+    parser.add_argument('--delta', metavar='FILE',
+            help="write the rows changed since the previous build of DATABASE to FILE as JSON")
+    parser.add_argument('--publish', action='store_true',
+            help="build into a separate file and atomically replace DATABASE with it")
+    parser.add_argument('--wal', action='store_true', help="use WAL journal mode for DATABASE")
+    parser.add_argument('--snapshot', action='store_true',
+            help="write a binary snapshot of the items and attributes next to DATABASE")
+    parser.add_argument('--cache', metavar='DIR',
+            help="cache the parsed items_game.txt in DIR and reuse it while the file is unchanged")
+    parser.add_argument('--cache-size', metavar='MB', type=int,
+            default=PARSE_CACHE_SIZE // (1024 * 1024), help="size limit of the cache directory")
+    parser.add_argument('--target', metavar='DATABASE[:OPTIONS]', action='append', default=[],
+            help="also build DATABASE from the same parse, OPTIONS being a comma-separated list "
+            "of {} added to the other options (can be repeated, not with --stats, --jobs, "
+            "--profile or --delta)".format(', '.join(TARGET_OPTIONS)))
 
     args = parser.parse_args()
 
@@ -340,4 +1480,54 @@ if __name__ == "__main__":
     if not os.path.isfile(args.database) and os.path.exists(args.database):
         raise ValueError("missing output database or is not a file")
 
-    main(args.items_game, args.database)
+    cache_state = ''
+    if args.cache:
+        warm = os.path.isfile(parse_cache_path(args.items_game, args.cache))
+        cache_state = ', warm cache' if warm else ', cold cache'
+
+    stats = BuildStats() if args.stats else None
+
+    options = dict(wal = args.wal, fast_build = args.fast, vacuum = not args.no_vacuum,
+            incremental = args.incremental, loadout = args.loadout,
+            coded_enums = args.coded_enums, search = args.search,
+            localization_file = args.localization, delta_file = args.delta)
+
+    def target(database, names = ()):
+        target_options = dict(options, **{ TARGET_OPTIONS[name][0]: TARGET_OPTIONS[name][1]
+                for name in names })
+        if target_options.pop('snapshot', args.snapshot):
+            target_options['snapshot_file'] = snapshot.snapshot_path(database)
+        return database, target_options
+
+    start = time.perf_counter()
+    if args.target:
+        # the targets are built in pool processes, which can not start processes of their own
+        # nor report back to BuildStats, and one delta file can not describe several databases
+        for flag, used in [ ('--stats', args.stats), ('--jobs', args.jobs != 1),
+                ('--profile', args.profile), ('--delta', args.delta) ]:
+            if used:
+                parser.error("{} can not be combined with --target".format(flag))
+        targets = [ target(args.database, [ 'publish' ] if args.publish else []) ]
+        for spec in args.target:
+            database, _, names = spec.partition(':')
+            names = [ name for name in names.split(',') if name ]
+            for name in names:
+                if name not in TARGET_OPTIONS:
+                    parser.error("unknown option '{}' for target {}".format(name, database))
+            targets.append(target(database, names))
+        build_targets(args.items_game, targets, cache_dir = args.cache,
+                cache_size = args.cache_size * 1024 * 1024)
+    else:
+        database, build_options = target(args.database)
+        build = publish if args.publish else main
+        build(args.items_game, database, cache_dir = args.cache,
+                cache_size = args.cache_size * 1024 * 1024, jobs = args.jobs, observer = stats,
+                profile = args.profile, **build_options)
+    print("Built {} in {:.2f}s ({} mode{}{}{}{})".format(
+            ', '.join([ args.database ] + [ spec.partition(':')[0] for spec in args.target ]), time.perf_counter() - start,
+            'fast' if args.fast else 'default', ', incremental' if args.incremental else '',
+            cache_state, ', no VACUUM' if args.no_vacuum else '',
+            ', published' if args.publish else ''))
+
+    if stats:
+        stats.print()
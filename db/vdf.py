@@ -8,6 +8,10 @@
 # use at your own risk 
 
 import re 
+import os
+import json
+import mmap
+import collections.abc
 from codecs import BOM, BOM_BE, BOM_LE, BOM_UTF8, BOM_UTF16, BOM_UTF16_BE, BOM_UTF16_LE, BOM_UTF32, BOM_UTF32_BE, BOM_UTF32_LE 
 
 
@@ -28,94 +32,406 @@ BOMS = [
 # 
 # Takes a file or str and returns dict 
 # 
-# Function assumes valid VDF as input. 
-# Invalid VDF will result in unexpected output 
+# Builds the dict from the events of tokenize(), 
+# raises SyntaxError on unbalanced brackets or 
+# unclosed quotes 
 # 
 ############################################### 
 
-def parse(a): 
-    a_type = type(a) 
-
-    if a_type is str: 
-        lines = a.split('\n') 
+def parse(a):
+    obj = dict()
+    stack = [obj]
+    key = None
+
+    for event, value in tokenize(a):
+        if event == KEY:
+            key = value
+        elif event == VALUE:
+            stack[-1][key] = value
+        elif event == OPEN:
+            stack[-1][key] = dict()
+            stack.append(stack[-1][key])
+        else:
+            stack.pop()
+
+    return obj
+
+###############################################
+#
+# Takes a file or str and yields (event, value)
+# pairs, one per key, value, opening bracket and
+# closing bracket, in document order
+#
+# The input is consumed CHUNK_SIZE characters at
+# a time, so memory use does not depend on the
+# size of the input
+#
+###############################################
+
+KEY = 0
+VALUE = 1
+OPEN = 2
+CLOSE = 3
+
+CHUNK_SIZE = 1 << 16
+
+# matches everything between two quoted strings: comments and conditionals ([$X360])
+# are skipped, brackets and unquoted strings are captured
+re_outside = re.compile(r'//[^\n]*|\[[^\]\n]*\]|([{}])|([^\s{}\[]+)')
+
+def tokenize(a):
+    if type(a) is str:
+        chunks = iter((a,))
+    elif hasattr(a, "read"):
+        chunks = iter(lambda: a.read(CHUNK_SIZE), "")
     else:
+        raise ValueError("Expected parametar to be file or str")
+
+    carry = next(chunks, "")
+
+    # check BOM and remove
+    if carry[:1] == "\ufeff":
+        carry = carry[1:]
+
+    # splitting on quotes alternates between text outside and inside of quoted strings,
+    # the last piece of every chunk is carried over as it may continue in the next one
+    inside = False
+    pending = None
+    comment = False
+    expect_value = False
+    depth = 0
+    eof = False
+
+    while not eof:
+        chunk = next(chunks, "")
+        eof = not chunk
+        buf = carry + chunk
+        escapes = "\\" in buf
+        parts = buf.split('"')
+        carry = "" if eof else parts.pop()
+
+        for p in parts:
+            # a comment runs until the end of the line, even across quotes
+            if comment:
+                i = p.find("\n")
+                if i < 0:
+                    continue
+                p = p[i + 1:]
+                comment = False
+                inside = False
+
+            if inside:
+                # an escaped quote does not end the string
+                if pending is not None or escapes and p[-1:] == "\\":
+                    if pending is not None:
+                        p = pending + p
+                        pending = None
+                    if (len(p) - len(p.rstrip("\\"))) % 2:
+                        pending = p + '"'
+                        continue
+
+                if expect_value:
+                    yield VALUE, p
+                    expect_value = False
+                else:
+                    yield KEY, p
+                    expect_value = True
+                inside = False
+                continue
+
+            inside = True
+            if not p or p.isspace():
+                continue
+
+            # fast path for lines with a single bracket
+            s = p.strip()
+            if s == "{" and expect_value:
+                depth += 1
+                expect_value = False
+                yield OPEN, None
+                continue
+            if s == "}" and not expect_value and depth:
+                depth -= 1
+                yield CLOSE, None
+                continue
+
+            tokens = re_outside.findall(p)
+            i = p.rfind("//")
+            comment = i >= 0 and "\n" not in p[i:]
+
+            for bracket, string in tokens:
+                if bracket == "{":
+                    # a key followed by a bracket starts a new dict obj (one level deep)
+                    if not expect_value:
+                        raise SyntaxError("vdf.parse: invalid syntax")
+                    depth += 1
+                    expect_value = False
+                    yield OPEN, None
+                elif bracket:
+                    if expect_value or depth == 0:
+                        raise SyntaxError("vdf.parse: invalid syntax")
+                    depth -= 1
+                    yield CLOSE, None
+                elif string:
+                    if expect_value:
+                        yield VALUE, string
+                        expect_value = False
+                    else:
+                        yield KEY, string
+                        expect_value = True
+
+    # the last piece must be outside of quotes
+    if not inside or pending is not None or depth != 0 or expect_value:
+        raise SyntaxError("vdf.parse: unclosed parenthasis or quotes")
+
+###############################################
+#
+# Takes a file or str and yields (path, key, value)
+# for every key `depth` levels deep, where path is
+# the tuple of parent keys and value is a str or
+# the full dict subtree
+#
+# Nothing above `depth` is kept in memory, so a
+# large section can be consumed one subtree at a
+# time. select(path, key) is called for every key
+# at or above `depth`; returning False skips it
+# and everything below it without building dicts
+#
+###############################################
+
+def iterparse(a, depth=1, select=None):
+    path = []
+    stack = []
+    key = None
+    subkey = None
+    skip = 0
+
+    for event, value in tokenize(a):
+        # inside a subtree that was not selected
+        if skip:
+            if event == OPEN:
+                skip += 1
+            elif event == CLOSE:
+                skip -= 1
+            continue
+
+        if event == KEY:
+            key = value
+
+        elif event == VALUE:
+            if stack:
+                stack[-1][key] = value
+            elif len(path) == depth and (select is None or select(tuple(path), key)):
+                yield tuple(path), key, value
+
+        elif event == OPEN:
+            if stack:
+                stack[-1][key] = dict()
+                stack.append(stack[-1][key])
+            elif select is not None and not select(tuple(path), key):
+                skip = 1
+            elif len(path) == depth:
+                subkey = key
+                stack.append(dict())
+            else:
+                path.append(key)
+
+        else:
+            if stack:
+                obj = stack.pop()
+                if not stack:
+                    yield tuple(path), subkey, obj
+            else:
+                path.pop()
+
+###############################################
+#
+# Takes a bytes-like object (an mmap of a file)
+# and returns the byte offsets of every key at
+# most `depth` levels deep, as a table of
+#
+#   keys       the keys, in file order
+#   offsets    start and end of each value
+#   kinds      one character per key: "s" for a
+#              string, "t" for a subtree with
+#              its own table, "d" for a subtree
+#              below `depth`
+#   tables     the tables of the "t" subtrees,
+#              keyed by their position in keys
+#              (as a str, like in JSON)
+#
+# where start and end delimit a string without
+# its quotes, or a subtree without its brackets
+#
+###############################################
+
+# matches quoted strings, comments, conditionals, brackets and unquoted strings like
+# tokenize() does
+re_token = re.compile(rb'"((?:[^"\\]|\\.)*)"|//[^\n]*|\[[^\]\n]*\]|([{}])|([^\s{}\[\]"]+)', re.S)
+
+def new_table():
+    return {"keys": [], "offsets": [], "kinds": [], "tables": {}}
+
+def index(buf, depth=2):
+    root = new_table()
+    tables = [root]
+    stack = []
+    key = None
+
+    start = 3 if buf[:3] == b"\xef\xbb\xbf" else 0
+    for m in re_token.finditer(buf, start):
+        quoted, bracket, unquoted = m.groups()
+        if bracket is None:
+            if quoted is None and unquoted is None:
+                continue
+            group = 1 if quoted is not None else 3
+            if key is None:
+                key = m.group(group)
+            else:
+                table = tables[-1]
+                if table is not None:
+                    table["keys"].append(key.decode("utf-8"))
+                    table["offsets"] += (m.start(group), m.end(group))
+                    table["kinds"].append("s")
+                key = None
+
+        elif bracket == b"{":
+            if key is None:
+                raise SyntaxError("vdf.index: invalid syntax")
+            table = tables[-1]
+            child = None
+            if table is not None:
+                if len(stack) < depth:
+                    child = table["tables"][str(len(table["keys"]))] = new_table()
+                table["keys"].append(key.decode("utf-8"))
+                table["offsets"] += (m.end(), None)
+                table["kinds"].append("d" if child is None else "t")
+            stack.append(table)
+            tables.append(child)
+            key = None
+
+        else:
+            if key is not None or not stack:
+                raise SyntaxError("vdf.index: invalid syntax")
+            tables.pop()
+            table = stack.pop()
+            if table is not None:
+                table["offsets"][-1] = m.start()
+
+    if stack or key is not None:
+        raise SyntaxError("vdf.index: unclosed parenthasis or quotes")
+
+    for table in iter_tables(root):
+        table["kinds"] = "".join(table["kinds"])
+    return root
+
+def iter_tables(table):
+    yield table
+    for child in table["tables"].values():
+        yield from iter_tables(child)
+
+###############################################
+#
+# A read-only mapping over a bytes-like object
+# (an mmap of a file) and its index(), parsing a
+# value only when it is first accessed; indexed
+# subtrees are mappings themselves, deeper ones
+# plain dicts like parse() returns
+#
+# load(path) returns one for a file, reading the
+# index from a sidecar file next to it, which is
+# written on the first load and whenever the file
+# changed. The sidecar only saves time: if it can
+# not be written (read-only directory) the index
+# is built in memory on every load
+#
+###############################################
+
+INDEX_VERSION = 1
+INDEX_EXTENSION = ".idx"
+
+class LazyDict(collections.abc.Mapping):
+    def __init__(self, buf, table):
+        self.buf = buf
+        self.table = table
+        # like parse(), a repeated key keeps its first position and its last value
+        self.positions = dict(zip(table["keys"], range(len(table["keys"]))))
+        self.values = {}
+
+    def __getitem__(self, key):
         try:
-            lines = a.readlines()
-        except:
-            raise ValueError("Expected parametar to be file or str") 
-
-    # check first line BOM and remove 
-    for bom in BOMS: 
-        if lines[0][:len(bom)] == bom: 
-            lines[0] = lines[0][len(bom):] 
-            break; 
-
-    # init 
-    obj = dict() 
-    stack = [obj] 
-    expect_bracket = False 
-    name = "" 
-
-    re_keyvalue = re.compile(r'^"((?:\\.|[^\\"])*)"[ \t]*"((?:\\.|[^\\"])*)(")?') 
-    re_key = re.compile(r'^"((?:\\.|[^\\"])*)"') 
-
-    itr = iter(lines) 
-
-    for line in itr: 
-        line = line.strip() 
-
-        # skip empty and comment lines 
-        if line == "" or line[0] == '/': 
-            continue 
-
-        # one level deeper 
-        if line[0] == "{": 
-            expect_bracket = False 
-            continue 
-
-        if expect_bracket: 
-            raise SyntaxError("vdf.parse: invalid syntax") 
-
-        # one level back 
-        if line[0] == "}": 
-            stack.pop() 
-            continue 
-
-        # parse keyvalue pairs 
-        if line[0] == '"': 
-            while True: 
-                m = re_keyvalue.match(line) 
-
-                # we've matched a simple keyvalue pair, map it to the last dict obj in the stack 
-                if m: 
-                    # if the value is line consume one more line and try to match again, until we get the KeyValue pair 
-                    if m.group(3) == None: 
-                        line += "\n" + itr.next() 
-                        continue 
-
-                    stack[-1][m.group(1)] = m.group(2) 
-
-                # we have a key with value in parenthesis, so we make a new dict obj (one level deep) 
-                else: 
-                    m = re_key.match(line) 
-
-                    if not m: 
-                        raise SyntaxError("vdf.parse: invalid syntax") 
-
-                    key = m.group(1) 
-
-                    stack[-1][key] = dict() 
-                    stack.append(stack[-1][key]) 
-                    expect_bracket = True 
-
-                # exit the loop 
-                break 
-
-    if len(stack) != 1: 
-        print(stack) 
-        raise SyntaxError("vdf.parse: unclosed parenthasis or quotes") 
-
-    return obj 
+            return self.values[key]
+        except KeyError:
+            pass
+
+        i = self.positions[key]
+        kind = self.table["kinds"][i]
+        if kind == "t":
+            value = LazyDict(self.buf, self.table["tables"][str(i)])
+        else:
+            start, end = self.table["offsets"][2 * i:2 * i + 2]
+            value = self.buf[start:end].decode("utf-8")
+            if kind == "d":
+                value = parse(value)
+        self.values[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def close(self):
+        # closes the file shared by every LazyDict of the same load()
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load(path, depth=2, index_path=None):
+    if index_path is None:
+        index_path = path + INDEX_EXTENSION
+
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+
+    # the index only holds for the file it was built from
+    header = {"version": INDEX_VERSION, "depth": depth, "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns}
+    try:
+        with open(index_path) as f:
+            data = json.load(f)
+        table = data["table"] if data["header"] == header else None
+    except (OSError, ValueError, KeyError, TypeError):
+        table = None
+
+    if table is None:
+        table = index(buf, depth)
+        temp_path = index_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump({"header": header, "table": table}, f, separators=(",", ":"))
+            os.replace(temp_path, index_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    return LazyDict(buf, table)
 
 ############################################### 
 # 
@@ -170,7 +486,7 @@ def test():
                 [ {"a":"1","b":"2"} , '"a" "1"\n"b" "2"\n' ], 
 
                 # nesting 
-                [ {"a":{"b":{"c":{"d":"1","e":"2"}}}} , '"a"\n{\n"b"\n{\n"c"\n{\n"e" "2"\n"d" "1"\n}\n}\n}\n' ], 
+                [ {"a":{"b":{"c":{"d":"1","e":"2"}}}} , '"a"\n{\n"b"\n{\n"c"\n{\n"d" "1"\n"e" "2"\n}\n}\n}\n' ], 
                 [ '"a"\n{\n"b"\n{\n"c"\n{\n"e" "2"\n"d" "1"\n}\n}\n}\n"b" "2"' , {"a":{"b":{"c":{"d":"1","e":"2"}}},"b":"2"} ], 
 
                 # ignoring comment lines 
@@ -184,9 +500,40 @@ def test():
                 # new linesi n value 
                 [ r'"a" "xx\"xxx"', {"a":r'xx\"xxx'} ], 
                 [ '"a" "xx\\"\nxxx"', {"a":'xx\\"\nxxx'} ], 
-                [ '"a" "\n\n\n\n"', {"a":'\n\n\n\n'} ] 
+                [ '"a" "\n\n\n\n"', {"a":'\n\n\n\n'} ], 
+
+                # brackets on the same line, unquoted tokens and conditionals 
+                [ '"a" { "b" "1" }', {"a":{"b":"1"}} ], 
+                [ 'a\n{\nb 1\nc "2" [$X360]\n}', {"a":{"b":"1","c":"2"}} ], 
+                [ '"a" [$WIN32]\n{\n}', {"a":{}} ] 
+            ] 
+
+    # subtrees at a given depth 
+    text = '"a"\n{\n"b" "1"\n"c"\n{\n"d" "2"\n}\n"e"\n{\n}\n}\n"f" "3"' 
+    iter_tests = [ 
+                [ (0, None), [ ((), "a", {"b":"1","c":{"d":"2"},"e":{}}), ((), "f", "3") ] ], 
+                [ (1, None), [ (("a",), "b", "1"), (("a",), "c", {"d":"2"}), (("a",), "e", {}) ] ], 
+                [ (2, None), [ (("a","c"), "d", "2") ] ], 
+                [ (1, lambda path, key: key != "c"), [ (("a",), "b", "1"), (("a",), "e", {}) ] ], 
+                [ (1, lambda path, key: key != "a"), [] ] 
             ] 
 
+    # lazy subtrees over the offsets of index() 
+    data = text.encode("utf-8") 
+    lazy = LazyDict(data, index(data, 1)) 
+    if dict(lazy["a"]) != parse(text)["a"] or lazy["f"] != "3" or list(lazy["a"]) != ["b", "c", "e"]: 
+        raise Exception("LazyDict differs from parse()") 
+
+    for (depth, select), expected in iter_tests: 
+        out = list(iterparse(text, depth, select)) 
+
+        if expected != out: 
+            print("Test falure (iterparse ouput mismatch):\n\ndepth=%d" % depth) 
+            print("\nOutput:\n\n%s" % str(out)) 
+            print("\nExpected:\n\n%s\n" % str(expected)) 
+
+            raise Exception("Output differs from expected result") 
+
     for test,expected in tests: 
         out = None 
 
@@ -199,7 +546,7 @@ def test():
             print("Test falure (exception):\n\n%s" % str(test)) 
             raise 
 
-        if cmp(expected,out) != 0: 
+        if expected != out: 
             print("Test falure (ouput mismatch):\n\n%s" % str(test)) 
             print("\nOutput:\n\n%s" % str(out)) 
             print("\nExpected:\n\n%s\n" % str(expected)) 